@@ -0,0 +1,483 @@
+# flake8: noqa E501
+"""
+*LabBot* - Offline LabManager benchmark
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Runs stand in Digital Ocean, Cloudflare and lab health servers on the
+loopback, then drives LabManager with N concurrent users:
+
+    python bench/labbench.py --users 50 --api-latency 0.2 --fail 0.05
+    python bench/labbench.py --class --users 40 --regions SFO2:8:15,NYC1:2,AMS3:3
+    python bench/labbench.py --users 40 --max-labs 10 --hold 2
+    python bench/labbench.py --users 40 --phone-home
+    python bench/labbench.py --users 40 --slow 0.1:30 --hedge
+
+Every user creates a lab, or with --class the whole roster is created
+by one create_labs call, half of them are then destroyed one by one
+with destroy_lab and the rest with a single destroy_all. With --hold
+every user destroys their own lab that long after it is ready instead,
+so a --max-labs below --users keeps the admission queue moving.
+
+Droplets get 127.x.y.z addresses, so the health server listens on
+0.0.0.0:8443 and answers per droplet from the address it was reached on.
+With --phone-home each droplet calls LabBot back as its application
+comes up, as the cloud-init script labbot gives it would. --slow makes
+a share of droplets take far longer to go active, --hedge turns on
+LabManager's hedged creates to race a second droplet against them.
+
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+
+LAB_PORT = 8443
+CF_ZONE_NAME = "bench.invalid"
+
+
+class FakeCloud(object):
+    """ Droplets and DNS records shared by the fake servers """
+
+    def __init__(self, latency, fail, boot, app_start, regions=None, slow=(0, 0)):
+        self.latency = latency
+        self.fail = fail
+        self.boot = boot
+        self.app_start = app_start
+        # {region: (boot seconds, droplet capacity or None)}
+        self.regions = regions or dict()
+        # (chance, extra seconds) of a droplet being slow to go active
+        self.slow = slow
+        self.placed = Counter()
+        self.lock = threading.Lock()
+        self.droplets = dict()
+        self.records = dict()
+        self.calls = Counter()
+        self._ids = iter(range(1, 1 << 20))
+
+    def delay(self, provider, operation):
+        with self.lock:
+            self.calls[(provider, operation)] += 1
+        if self.latency:
+            time.sleep(random.uniform(self.latency / 2, self.latency * 1.5))
+
+    def failed(self):
+        return random.random() < self.fail
+
+    def full(self, region, count):
+        """ True if region has no room for count more droplets, must hold lock """
+        capacity = self.regions.get(region, (self.boot, None))[1]
+        live = sum(1 for d in self.droplets.values() if d["region"] == region)
+        return capacity is not None and live + count > capacity
+
+    def new_droplet(self, body):
+        with self.lock:
+            droplet_id = next(self._ids)
+            now = time.time()
+            boot = self.regions.get(body.get("region"), (self.boot, None))[0]
+            if random.random() < self.slow[0]:
+                boot += self.slow[1]
+            self.placed[body.get("region")] += 1
+            droplet = {
+                "id": droplet_id,
+                "name": body["name"],
+                "tags": body.get("tags") or [],
+                "region": body.get("region"),
+                "ip": f"127.{droplet_id >> 16 & 255}.{droplet_id >> 8 & 255}.{droplet_id & 255}",
+                "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "active_at": now + boot,
+                # A failed lab boots but its application never answers
+                "healthy_at": None if self.failed() else now + boot + self.app_start,
+            }
+            self.droplets[droplet_id] = droplet
+        if droplet["healthy_at"] is not None and body.get("user_data"):
+            self.phone_home(droplet, body["user_data"])
+        return droplet
+
+    def phone_home(self, droplet, user_data):
+        """ Call back the way labbot's cloud-init script does once the app is up """
+        url = re.search(r"-X POST '?([^'\s]+?)'?/phone-home/", user_data)
+        token = re.search(
+            rf"^\s*'?{re.escape(droplet['name'].lower())}'?\) token='?([\w-]+)'?", user_data, re.M
+        )
+        if url is None or token is None:
+            return
+
+        def call():
+            try:
+                urlopen(Request(f"{url.group(1)}/phone-home/{token.group(1)}", method="POST"), timeout=5)
+            except Exception:
+                pass
+
+        threading.Timer(droplet["healthy_at"] - time.time(), call).start()
+
+    def droplet_json(self, d):
+        active = time.time() >= d["active_at"]
+        return {
+            "id": d["id"],
+            "name": d["name"],
+            "tags": d["tags"],
+            "status": "active" if active else "new",
+            "created_at": d["created_at"],
+            "features": [],
+            "networks": {
+                "v4": [{"ip_address": d["ip"], "type": "public"}] if active else [],
+                "v6": [],
+            },
+        }
+
+    def healthy(self, ip):
+        with self.lock:
+            d = next((d for d in self.droplets.values() if d["ip"] == ip), None)
+        return d is not None and d["healthy_at"] is not None and time.time() >= d["healthy_at"]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    cloud = None
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+
+    def _reply(self, code, data=None):
+        payload = json.dumps(data).encode() if data is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class DOHandler(_Handler):
+    """ The handful of /v2 endpoints labbot.cloud.do uses """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") == "/v2/account":
+            self.cloud.delay("do", "account")
+            return self._reply(200, {"account": {"email": "bench@example.com", "status": "active"}})
+        self.cloud.delay("do", "list")
+        tag = parse_qs(url.query).get("tag_name", [None])[0]
+        with self.cloud.lock:
+            droplets = [
+                self.cloud.droplet_json(d)
+                for d in self.cloud.droplets.values()
+                if tag is None or tag in d["tags"]
+            ]
+        self._reply(200, {"droplets": droplets, "links": {}, "meta": {"total": len(droplets)}})
+
+    def do_POST(self):
+        path = urlparse(self.path).path.rstrip("/")
+        body = self._body()
+        if path == "/v2/droplets":
+            self.cloud.delay("do", "create")
+            if self.cloud.failed():
+                return self._reply(500, {"id": "server_error", "message": "Injected failure"})
+            with self.cloud.lock:
+                full = self.cloud.full(body.get("region"), len(body.get("names", [None])))
+            if full:
+                return self._reply(422, {"id": "unprocessable_entity", "message": "Size is not available in this region."})
+            if "names" in body:
+                droplets = [self.cloud.new_droplet(dict(body, name=name)) for name in body["names"]]
+                return self._reply(202, {"droplets": [self.cloud.droplet_json(d) for d in droplets], "links": {"actions": [{"id": droplets[0]["id"]}]}})
+            d = self.cloud.new_droplet(body)
+            return self._reply(202, {"droplet": self.cloud.droplet_json(d), "links": {"actions": [{"id": d["id"]}]}})
+        if path == "/v2/tags":
+            self.cloud.delay("do", "tag")
+            return self._reply(201, {"tag": {"name": body.get("name"), "resources": {}}})
+        self.cloud.delay("do", "tag")
+        self._tag(path, body, add=True)
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path.rstrip("/")
+        if path.startswith("/v2/tags/"):
+            self.cloud.delay("do", "untag")
+            return self._tag(path, self._body(), add=False)
+        self.cloud.delay("do", "destroy")
+        with self.cloud.lock:
+            found = self.cloud.droplets.pop(int(path.rsplit("/", 1)[1]), None)
+        self._reply(204 if found else 404, None if found else {"id": "not_found", "message": "Not found"})
+
+    def _tag(self, path, body, add):
+        tag = path.split("/")[3]
+        with self.cloud.lock:
+            for r in body.get("resources", []):
+                d = self.cloud.droplets.get(int(r["resource_id"]))
+                if d is None:
+                    continue
+                if add and tag not in d["tags"]:
+                    d["tags"].append(tag)
+                elif not add and tag in d["tags"]:
+                    d["tags"].remove(tag)
+        self._reply(204)
+
+
+class CFHandler(_Handler):
+    """ zones/<zone>/dns_records, as used by labbot.cloud.cloudflare """
+
+    def _ok(self, result, code=200):
+        self._reply(code, {"success": True, "errors": [], "messages": [], "result": result})
+
+    def do_GET(self):
+        self.cloud.delay("cf", "list")
+        query = parse_qs(urlparse(self.path).query)
+        page = int(query.get("page", [1])[0])
+        per_page = int(query.get("per_page", [100])[0])
+        with self.cloud.lock:
+            records = list(self.cloud.records.values())
+        self._ok(records[(page - 1) * per_page:page * per_page])
+
+    def do_POST(self):
+        self.cloud.delay("cf", "create")
+        body = self._body()
+        record = {
+            "id": "%032x" % random.getrandbits(128),
+            "name": f"{body['name']}.{CF_ZONE_NAME}",
+            "type": "A",
+            "content": body["content"],
+            "created_on": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        }
+        with self.cloud.lock:
+            self.cloud.records[record["id"]] = record
+        self._ok(record)
+
+    def do_DELETE(self):
+        self.cloud.delay("cf", "delete")
+        record_id = urlparse(self.path).path.rstrip("/").rsplit("/", 1)[1]
+        with self.cloud.lock:
+            found = self.cloud.records.pop(record_id, None)
+        if found is None:
+            return self._reply(404, {"success": False, "errors": [{"code": 81044, "message": "Record not found"}], "result": None})
+        self._ok({"id": record_id})
+
+
+class LabHandler(_Handler):
+    """ The :8443 health endpoint of every fake droplet """
+
+    def do_GET(self):
+        with self.cloud.lock:
+            self.cloud.calls[("lab", "health")] += 1
+        if self.cloud.healthy(self.connection.getsockname()[0]):
+            return self._reply(200, {"status": "ok"})
+        self._reply(503, {"status": "starting"})
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # A class worth of labs connects at once
+    request_queue_size = 256
+
+
+def serve(handler, cloud, address):
+    handler = type(handler.__name__, (handler,), {"cloud": cloud})
+    server = _Server(address, handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class TimedLock(object):
+    """ Drop in for LabManager.list_lock that adds up time spent waiting """
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.acquired = 0
+
+    def acquire(self, *args, **kwargs):
+        _start = time.perf_counter()
+        ok = self._lock.acquire(*args, **kwargs)
+        _waited = time.perf_counter() - _start
+        self.waited += _waited
+        self.max_wait = max(self.max_wait, _waited)
+        self.acquired += 1
+        return ok
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def percentile(values, p):
+    """ Nearest rank percentile, None for no values """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summary(name, values, total):
+    if not values:
+        return f"{name:<14} 0/{total} ok"
+    p50, p95, p99 = (percentile(values, p) for p in (50, 95, 99))
+    return f"{name:<14} {len(values)}/{total} ok  p50 {p50:.2f}s  p95 {p95:.2f}s  p99 {p99:.2f}s  max {max(values):.2f}s"
+
+
+def timed_call(fn, *args):
+    _start = time.perf_counter()
+    try:
+        ok = fn(*args) is not None
+    except Exception as e:
+        print(f"{fn.__name__}{args} raised {e}")
+        ok = False
+    return ok, time.perf_counter() - _start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline LabManager benchmark")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated Slack users")
+    parser.add_argument("--pool", type=int, default=0, help="LabManager pool_size")
+    parser.add_argument("--api-latency", type=float, default=0.1, help="mean fake API latency in seconds")
+    parser.add_argument("--fail", type=float, default=0.0, help="chance a droplet create or lab health check fails")
+    parser.add_argument("--boot", type=float, default=2.0, help="seconds until a droplet is active")
+    parser.add_argument("--app-start", type=float, default=1.0, help="seconds after boot until the lab answers")
+    parser.add_argument("--health-timeout", type=float, default=10.0, help="LAB_HEALTH_TIMEOUT for the run")
+    parser.add_argument("--class", dest="bulk", action="store_true", help="create the labs with one create_labs call")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the real DO / CF rate limits")
+    parser.add_argument("--max-labs", type=int, help="LabManager max_labs, extra users queue for a slot (default --users)")
+    parser.add_argument("--hold", type=float, help="seconds each user keeps their lab before destroying it")
+    parser.add_argument("--regions", help="NAME:BOOT[:CAPACITY],... regions with their own boot seconds and droplet capacity")
+    parser.add_argument("--phone-home", action="store_true", help="droplets call back when their lab is up, probing only as a fallback")
+    parser.add_argument("--slow", help="CHANCE:SECONDS a droplet takes SECONDS longer to go active")
+    parser.add_argument("--hedge", action="store_true", help="race a second droplet against creates slower than recent ones")
+    parser.add_argument("--hedge-after", type=float, help="DO_HEDGE_AFTER, seconds before hedging until enough creates are timed (default 3 x --boot)")
+    args = parser.parse_args(argv)
+
+    regions = dict()
+    for spec in (args.regions or "").split(","):
+        if spec:
+            name, boot, capacity = (spec.split(":") + [None, None])[:3]
+            regions[name] = (float(boot or args.boot), int(capacity) if capacity else None)
+
+    slow = tuple(float(x) for x in args.slow.split(":")) if args.slow else (0, 0)
+    cloud = FakeCloud(args.api_latency, args.fail, args.boot, args.app_start, regions, slow)
+    do_server = serve(DOHandler, cloud, ("127.0.0.1", 0))
+    cf_server = serve(CFHandler, cloud, ("127.0.0.1", 0))
+    serve(LabHandler, cloud, ("0.0.0.0", LAB_PORT))
+    workdir = tempfile.mkdtemp(prefix="labbench-")
+
+    # labbot reads its settings at import time
+    os.environ.update(
+        {
+            "DO_API_TOKEN": "bench",
+            "DIGITALOCEAN_END_POINT": f"http://127.0.0.1:{do_server.server_port}/v2/",
+            "CF_API_URL": f"http://127.0.0.1:{cf_server.server_port}/client/v4",
+            "CF_API_EMAIL": "bench@example.com",
+            "CF_API_KEY": "bench",
+            "CF_ZONE": "benchzone",
+            "DO_POLL_MIN": "0.5",
+            "DO_POLL_MAX": "2",
+            "LAB_HEALTH_TIMEOUT": str(args.health_timeout),
+            "LAB_PROBE_BACKOFF_MAX": "2",
+            "LAB_RECONCILE_INTERVAL": str(24 * 60 * 60),
+            "DO_HEDGE_AFTER": str(args.hedge_after if args.hedge_after is not None else 3 * args.boot),
+        }
+    )
+    if not args.rate_limits:
+        os.environ.update({"DO_RATE": "1000000", "CF_RATE": "1000000"})
+    if regions:
+        os.environ["DO_ZONES"] = ",".join(regions)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+    from sqlalchemy import event
+    from labbot.database import DB
+    from labbot.lab import LabManager
+    from labbot.cloud.clients import stats
+    from labbot.cloud.do import hedge_stats
+    from labbot.phonehome import PhoneHome
+    from labbot import metrics
+
+    # Newer python-cloudflare also reads CF_API_KEY and then refuses the
+    # token labbot passes in, labbot has its copy by now
+    os.environ.pop("CF_API_KEY")
+
+    if args.phone_home:
+        PhoneHome().serve(0, host="127.0.0.1")
+
+    db = DB(f"sqlite:///{workdir}/labbench.db")
+    commits = Counter()
+    event.listen(db.engine, "commit", lambda conn: commits.update(["commit"]))
+
+    manager = LabManager(db, default_max_labs=args.max_labs or args.users, default_lab_lifetime=60 * 60, pool_size=args.pool, hedge=args.hedge)
+    manager.list_lock = TimedLock(manager.list_lock)
+
+    users = [f"U{i:05d}" for i in range(args.users)]
+    half = users[: len(users) // 2]
+
+    def session(u):
+        # Done with the lab after --hold, its slot goes to the next in line
+        result = timed_call(manager.create_lab, u)
+        time.sleep(args.hold)
+        timed_call(manager.destroy_lab, u)
+        return result
+
+    _start = time.perf_counter()
+    if args.hold is not None:
+        with ThreadPoolExecutor(max_workers=args.users) as executor:
+            created = list(executor.map(session, users))
+        half = []
+    elif args.bulk:
+        ready, _ = manager.create_labs(users)
+        created = [(u in ready, time.perf_counter() - _start) for u in users]
+    else:
+        with ThreadPoolExecutor(max_workers=args.users) as executor:
+            created = list(executor.map(lambda u: timed_call(manager.create_lab, u), users))
+    create_wall = time.perf_counter() - _start
+    create_commits = commits["commit"]
+
+    with ThreadPoolExecutor(max_workers=max(len(half), 1)) as executor:
+        destroyed = list(executor.map(lambda u: timed_call(manager.destroy_lab, u), half))
+
+    _start = time.perf_counter()
+    done, failed = manager.destroy_all()
+    destroy_all_wall = time.perf_counter() - _start
+
+    labs = max(args.users, 1)
+    api_calls = sum(cloud.calls.values())
+    print(f"\n{args.users} users, max labs {manager.max_labs}, pool {args.pool}, api latency {args.api_latency}s, fail {args.fail}, phone home {args.phone_home}, slow {args.slow}, hedge {args.hedge}")
+    print(summary("time to ready", [t for ok, t in created if ok], len(users)) + f"  (wall {create_wall:.2f}s)")
+    print(summary("destroy_lab", [t for ok, t in destroyed if ok], len(half)))
+    print(f"{'destroy_all':<14} {len(done)} done, {len(failed)} failed in {destroy_all_wall:.2f}s")
+    print(f"api calls      {api_calls} total, {api_calls / labs:.1f} per lab")
+    for (provider, operation), count in sorted(cloud.calls.items()):
+        print(f"  {provider} {operation:<10} {count:>6}  {count / labs:.1f}/lab")
+    for provider, s in sorted(stats().items()):
+        print(f"  {provider} client side: {s['calls']} calls, {s['errors']} errors, mean {s['mean']:.3f}s, throttled {s.get('throttled', 0)}")
+    hedges = hedge_stats()
+    print(f"droplets       {sum(cloud.placed.values())} created for {labs} labs, {hedges['launched']} hedges, {hedges['won']} used, {len(cloud.droplets)} left")
+    if regions:
+        print("placement      " + ", ".join(f"{r} {cloud.placed[r]}" for r in regions))
+    for line in metrics.summary(metrics.STAGE_SECONDS):
+        print(f"  stage {line}")
+    lock = manager.list_lock
+    print(f"list_lock      {lock.acquired} acquisitions, {lock.waited * 1000:.1f}ms waiting, max {lock.max_wait * 1000:.2f}ms")
+    print(f"db commits     {commits['commit']} total, {create_commits / labs:.1f} per lab created")
+
+
+if __name__ == "__main__":
+    main()
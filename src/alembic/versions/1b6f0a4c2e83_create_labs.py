@@ -0,0 +1,43 @@
+"""create labs
+
+Revision ID: 1b6f0a4c2e83
+Revises:
+Create Date: 2026-10-18 14:31:06.274519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1b6f0a4c2e83'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # labbot runs create_all on start, so only an empty database lacks it
+    if "labs" in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        "labs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("slack_owner_id", sa.String(length=22), nullable=True),
+        sa.Column("url", sa.String(length=255), nullable=True),
+        sa.Column("ip", sa.String(length=16), nullable=True),
+        sa.Column("do_reference", sa.String(length=255), nullable=True),
+        sa.Column("cf_reference", sa.String(length=255), nullable=True),
+        sa.Column("active", sa.Boolean(), nullable=True),
+        sa.Column("status", sa.String(19), nullable=True),
+        sa.Column("instances", sa.Integer(), nullable=True),
+        sa.Column("ts_created", sa.DateTime(), nullable=True),
+        sa.Column("ts_updated", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    # labs predates these revisions on most databases, it is left in place
+    pass
@@ -0,0 +1,133 @@
+"""archive terminated labs
+
+Revision ID: 3f1c2a9d8b7e
+Revises: 1b6f0a4c2e83
+Create Date: 2026-10-18 09:12:44.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d8b7e'
+down_revision = '1b6f0a4c2e83'
+branch_labels = None
+depends_on = None
+
+LAB_STATUS = (
+    "UNKNOWN",
+    "PENDING",
+    "POOL_WAITING_INSTANCE",
+    "POOL_WAITING_HEALTH",
+    "POOL_READY",
+    "WAITING_INSTANCE",
+    "WAITING_DNS",
+    "WAITING_HEALTH",
+    "ACTIVE",
+    "DEACTIVATE_DNS",
+    "DEACTIVATE_INSTANCE",
+    "TERMINATED",
+)
+
+LAB_COLUMNS = (
+    "id, slack_owner_id, url, ip, do_reference, cf_reference, active, "
+    "status, instances, ts_created, ts_updated"
+)
+
+
+def _existing():
+    inspector = sa.inspect(op.get_bind())
+    tables = inspector.get_table_names()
+    indexes = {
+        t: {i["name"] for i in inspector.get_indexes(t)} for t in tables
+    }
+    return tables, indexes
+
+
+def _status_type():
+    if op.get_bind().dialect.name == "postgresql":
+        # _widen_status made the type, creating the table must not repeat it
+        return postgresql.ENUM(*LAB_STATUS, name="labstatus", create_type=False)
+    return sa.Enum(*LAB_STATUS, name="labstatus")
+
+
+def _widen_status():
+    """ Widen the status enum for the pool states """
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        # A native enum type, the one create_all made from the old model
+        # lacks the pool states and values can be added but not dropped
+        postgresql.ENUM(*LAB_STATUS, name="labstatus").create(bind, checkfirst=True)
+        with op.get_context().autocommit_block():
+            for value in LAB_STATUS:
+                op.execute(f"ALTER TYPE labstatus ADD VALUE IF NOT EXISTS '{value}'")
+        columns = {c["name"]: c["type"] for c in sa.inspect(bind).get_columns("labs")}
+        if not isinstance(columns["status"], sa.Enum):
+            op.execute(
+                "ALTER TABLE labs ALTER COLUMN status TYPE labstatus "
+                "USING status::labstatus"
+            )
+        return
+    # SQLite rebuilds the table with the new CHECK constraint, and stops
+    # id reuse as archived ids must stay unique
+    with op.batch_alter_table(
+        "labs", recreate="always", table_kwargs={"sqlite_autoincrement": True}
+    ) as batch_op:
+        batch_op.alter_column(
+            "status",
+            existing_type=sa.String(19),
+            type_=sa.Enum(*LAB_STATUS, name="labstatus"),
+        )
+
+
+def upgrade():
+    # labbot runs create_all on start, so any of this may already exist
+    tables, indexes = _existing()
+
+    _widen_status()
+
+    if "ix_labs_slack_owner_id" not in indexes.get("labs", ()):
+        op.create_index("ix_labs_slack_owner_id", "labs", ["slack_owner_id"])
+    if "ix_labs_status" not in indexes.get("labs", ()):
+        op.create_index("ix_labs_status", "labs", ["status"])
+
+    if "labs_archive" not in tables:
+        op.create_table(
+            "labs_archive",
+            sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column("slack_owner_id", sa.String(length=22), nullable=True),
+            sa.Column("url", sa.String(length=255), nullable=True),
+            sa.Column("ip", sa.String(length=16), nullable=True),
+            sa.Column("do_reference", sa.String(length=255), nullable=True),
+            sa.Column("cf_reference", sa.String(length=255), nullable=True),
+            sa.Column("active", sa.Boolean(), nullable=True),
+            sa.Column("status", _status_type(), nullable=True),
+            sa.Column("instances", sa.Integer(), nullable=True),
+            sa.Column("ts_created", sa.DateTime(), nullable=True),
+            sa.Column("ts_updated", sa.DateTime(), nullable=True),
+            sa.Column("ts_archived", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+        op.create_index(
+            "ix_labs_archive_slack_owner_id", "labs_archive", ["slack_owner_id"]
+        )
+
+    op.execute(
+        f"INSERT INTO labs_archive ({LAB_COLUMNS}, ts_archived) "
+        f"SELECT {LAB_COLUMNS}, CURRENT_TIMESTAMP FROM labs "
+        "WHERE status = 'TERMINATED'"
+    )
+    op.execute("DELETE FROM labs WHERE status = 'TERMINATED'")
+
+
+def downgrade():
+    op.execute(
+        f"INSERT INTO labs ({LAB_COLUMNS}) "
+        f"SELECT {LAB_COLUMNS} FROM labs_archive"
+    )
+    op.drop_index("ix_labs_archive_slack_owner_id", table_name="labs_archive")
+    op.drop_table("labs_archive")
+    op.drop_index("ix_labs_status", table_name="labs")
+    op.drop_index("ix_labs_slack_owner_id", table_name="labs")
@@ -0,0 +1,80 @@
+"""add reset jobs and lab rebuild actions
+
+Revision ID: 4e8c1d7b9a25
+Revises: 9d3b5f7a2c41
+Create Date: 2026-10-18 21:37:42.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4e8c1d7b9a25'
+down_revision = '9d3b5f7a2c41'
+branch_labels = None
+depends_on = None
+
+OLD_KINDS = ("CREATE", "DESTROY", "DESTROY_ALL")
+NEW_KINDS = OLD_KINDS + ("RESET",)
+JOB_STATUS = ("QUEUED", "RUNNING", "DONE", "FAILED")
+LAB_STATUS = (
+    "UNKNOWN",
+    "PENDING",
+    "POOL_WAITING_INSTANCE",
+    "POOL_WAITING_HEALTH",
+    "POOL_READY",
+    "WAITING_INSTANCE",
+    "WAITING_DNS",
+    "WAITING_HEALTH",
+    "ACTIVE",
+    "DEACTIVATE_DNS",
+    "DEACTIVATE_INSTANCE",
+    "TERMINATED",
+)
+
+
+def _kinds(old, new):
+    if op.get_bind().dialect.name == "postgresql":
+        # A native enum type, values can be added but not dropped
+        if "RESET" in new:
+            with op.get_context().autocommit_block():
+                op.execute("ALTER TYPE jobkind ADD VALUE IF NOT EXISTS 'RESET'")
+        return
+    # SQLite rebuilds the table with the new CHECK constraint. Reflection
+    # does not see the status CHECK, so status is given to keep it
+    with op.batch_alter_table(
+        "lab_jobs",
+        reflect_args=[sa.Column("status", sa.Enum(*JOB_STATUS, name="jobstatus"))],
+    ) as batch_op:
+        batch_op.alter_column(
+            "kind",
+            existing_type=sa.Enum(*old, name="jobkind"),
+            type_=sa.Enum(*new, name="jobkind"),
+            existing_nullable=False,
+        )
+
+
+def upgrade():
+    _kinds(OLD_KINDS, NEW_KINDS)
+    # labbot runs create_all on start, so the column may already exist
+    columns = {c["name"] for c in sa.inspect(op.get_bind()).get_columns("labs")}
+    if "do_action" not in columns:
+        with op.batch_alter_table("labs") as batch_op:
+            batch_op.add_column(sa.Column("do_action", sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    # Dropping a column rebuilds labs on SQLite, keep its CHECKs as above
+    # and the AUTOINCREMENT archived ids rely on
+    with op.batch_alter_table(
+        "labs",
+        table_kwargs={"sqlite_autoincrement": True},
+        reflect_args=[
+            sa.Column("active", sa.Boolean()),
+            sa.Column("status", sa.Enum(*LAB_STATUS, name="labstatus")),
+        ],
+    ) as batch_op:
+        batch_op.drop_column("do_action")
+    op.execute("DELETE FROM lab_jobs WHERE kind = 'RESET'")
+    _kinds(NEW_KINDS, OLD_KINDS)
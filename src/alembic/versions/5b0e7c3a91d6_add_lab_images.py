@@ -0,0 +1,47 @@
+"""add lab images
+
+Revision ID: 5b0e7c3a91d6
+Revises: c7e93b1f04d2
+Create Date: 2026-10-18 16:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0e7c3a91d6'
+down_revision = 'c7e93b1f04d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # labbot runs create_all on start, so the table may already exist
+    if "lab_images" in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        "lab_images",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column("region", sa.String(length=16), nullable=True),
+        sa.Column("snapshot_id", sa.String(length=255), nullable=True),
+        sa.Column(
+            "status",
+            sa.Enum("BUILDING", "READY", "FAILED", "RETIRED", name="imagestatus"),
+            nullable=True,
+        ),
+        sa.Column("error", sa.String(length=255), nullable=True),
+        sa.Column("ts_created", sa.DateTime(), nullable=True),
+        sa.Column("ts_updated", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_lab_images_region", "lab_images", ["region"])
+    op.create_index("ix_lab_images_status", "lab_images", ["status"])
+
+
+def downgrade():
+    op.drop_index("ix_lab_images_status", table_name="lab_images")
+    op.drop_index("ix_lab_images_region", table_name="lab_images")
+    op.drop_table("lab_images")
@@ -0,0 +1,51 @@
+"""add lab jobs
+
+Revision ID: 8a4d6e21c5f0
+Revises: 3f1c2a9d8b7e
+Create Date: 2026-10-18 11:02:17.540981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d6e21c5f0'
+down_revision = '3f1c2a9d8b7e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # labbot runs create_all on start, so the table may already exist
+    if "lab_jobs" in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        "lab_jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column(
+            "kind",
+            sa.Enum("CREATE", "DESTROY", "DESTROY_ALL", name="jobkind"),
+            nullable=False,
+        ),
+        sa.Column("slack_id", sa.String(length=22), nullable=True),
+        sa.Column(
+            "status",
+            sa.Enum("QUEUED", "RUNNING", "DONE", "FAILED", name="jobstatus"),
+            nullable=True,
+        ),
+        sa.Column("attempts", sa.Integer(), nullable=True),
+        sa.Column("error", sa.String(length=255), nullable=True),
+        sa.Column("ts_created", sa.DateTime(), nullable=True),
+        sa.Column("ts_updated", sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_lab_jobs_slack_id", "lab_jobs", ["slack_id"])
+    op.create_index("ix_lab_jobs_status", "lab_jobs", ["status"])
+
+
+def downgrade():
+    op.drop_index("ix_lab_jobs_status", table_name="lab_jobs")
+    op.drop_index("ix_lab_jobs_slack_id", table_name="lab_jobs")
+    op.drop_table("lab_jobs")
@@ -0,0 +1,58 @@
+"""add replica leases
+
+Revision ID: 9d3b5f7a2c41
+Revises: e2a4f6b8d013
+Create Date: 2026-10-18 20:41:07.553918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3b5f7a2c41'
+down_revision = 'e2a4f6b8d013'
+branch_labels = None
+depends_on = None
+
+TABLES = ("labs", "lab_jobs")
+
+
+def upgrade():
+    # labbot runs create_all on start, so new tables may already exist
+    inspector = sa.inspect(op.get_bind())
+    for table in TABLES:
+        columns = {c["name"] for c in inspector.get_columns(table)}
+        with op.batch_alter_table(table) as batch_op:
+            if "lease_owner" not in columns:
+                batch_op.add_column(sa.Column("lease_owner", sa.String(length=64), nullable=True))
+            if "lease_expires" not in columns:
+                batch_op.add_column(sa.Column("lease_expires", sa.DateTime(), nullable=True))
+
+    # Terminated labs are archived, so a live owner appears at most once
+    indexes = {i["name"]: i for i in inspector.get_indexes("labs")}
+    if not indexes.get("ix_labs_slack_owner_id", {}).get("unique"):
+        with op.batch_alter_table("labs") as batch_op:
+            if "ix_labs_slack_owner_id" in indexes:
+                batch_op.drop_index("ix_labs_slack_owner_id")
+            batch_op.create_index("ix_labs_slack_owner_id", ["slack_owner_id"], unique=True)
+
+    if "lab_locks" not in inspector.get_table_names():
+        op.create_table(
+            "lab_locks",
+            sa.Column("name", sa.String(length=32), nullable=False),
+            sa.Column("lease_owner", sa.String(length=64), nullable=True),
+            sa.Column("lease_expires", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("name"),
+        )
+
+
+def downgrade():
+    op.drop_table("lab_locks")
+    with op.batch_alter_table("labs") as batch_op:
+        batch_op.drop_index("ix_labs_slack_owner_id")
+        batch_op.create_index("ix_labs_slack_owner_id", ["slack_owner_id"])
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column("lease_expires")
+            batch_op.drop_column("lease_owner")
@@ -0,0 +1,32 @@
+"""add lab expiry
+
+Revision ID: c7e93b1f04d2
+Revises: 8a4d6e21c5f0
+Create Date: 2026-10-18 13:27:51.302664
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e93b1f04d2'
+down_revision = '8a4d6e21c5f0'
+branch_labels = None
+depends_on = None
+
+TABLES = ("labs", "labs_archive")
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table in TABLES:
+        if "ts_expires" not in {c["name"] for c in inspector.get_columns(table)}:
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.add_column(sa.Column("ts_expires", sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    for table in TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column("ts_expires")
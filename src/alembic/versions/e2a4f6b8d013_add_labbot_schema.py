@@ -0,0 +1,32 @@
+"""add labbot schema fingerprint
+
+Revision ID: e2a4f6b8d013
+Revises: 5b0e7c3a91d6
+Create Date: 2026-10-18 18:05:12.402117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a4f6b8d013'
+down_revision = '5b0e7c3a91d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # labbot runs create_all on start, so the table may already exist
+    if "labbot_schema" in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    op.create_table(
+        "labbot_schema",
+        sa.Column("fingerprint", sa.String(length=40), nullable=False),
+        sa.PrimaryKeyConstraint("fingerprint"),
+    )
+
+
+def downgrade():
+    op.drop_table("labbot_schema")
@@ -0,0 +1,98 @@
+# flake8: noqa E501
+"""
+*LabBot* - Lab admission queue
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Owners asking for a lab while every slot is taken wait here in order,
+each freed slot is held for the owner at the front until they use it.
+
+"""
+
+import os
+import time
+from collections import OrderedDict
+
+# Seconds an admitted owner's slot is held for them before it is released
+ADMISSION_HOLD = float(os.environ.get("LAB_ADMISSION_HOLD", 5 * 60))
+
+
+class AdmissionQueue(object):
+    """
+    FIFO of owners waiting for a lab slot, guarded by the manager's list_lock
+
+    enqueue() records start, a callable run once the owner has a slot held
+    for them. The owner then goes through LabManager._reserve again, where
+    holds() lets them past the capacity check and take() gives the slot up
+    as their lab is indexed.
+    """
+
+    def __init__(self, hold=ADMISSION_HOLD):
+        self.hold = hold
+        self._waiting = OrderedDict()
+        self._held = dict()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, slack_id):
+        return slack_id in self._waiting
+
+    def _expire(self, now):
+        for slack_id in [k for k, until in self._held.items() if until <= now]:
+            del self._held[slack_id]
+
+    def reserved(self):
+        """ Number of slots held for admitted owners """
+        self._expire(time.time())
+        return len(self._held)
+
+    def holds(self, slack_id):
+        self._expire(time.time())
+        return slack_id in self._held
+
+    def take(self, slack_id):
+        """ Give up slack_id's held slot, their lab now counts instead """
+        self._held.pop(slack_id, None)
+
+    def waiting(self):
+        """ Owners in line, front first """
+        return list(self._waiting)
+
+    def position(self, slack_id):
+        """ 1 based place in line, None if not waiting """
+        for i, k in enumerate(self._waiting, 1):
+            if k == slack_id:
+                return i
+        return None
+
+    def enqueue(self, slack_id, start, front=False):
+        """ Add slack_id at the back (or front) of the line, returns their position """
+        self._waiting[slack_id] = start
+        if front:
+            self._waiting.move_to_end(slack_id, last=False)
+            return 1
+        return len(self._waiting)
+
+    def cancel(self, slack_id):
+        """ Take slack_id out of line or release their held slot, True if either """
+        held = self._held.pop(slack_id, None) is not None
+        return self._waiting.pop(slack_id, None) is not None or held
+
+    def clear(self):
+        """ Empty the line and release every held slot, returns [(slack_id, start)] of those waiting """
+        cancelled = list(self._waiting.items())
+        self._waiting.clear()
+        self._held.clear()
+        return cancelled
+
+    def admit(self, free):
+        """ Hold up to free slots for the front of the line, returns [(slack_id, start)] """
+        now = time.time()
+        self._expire(now)
+        admitted = []
+        while self._waiting and len(admitted) < free:
+            slack_id, start = self._waiting.popitem(last=False)
+            self._held[slack_id] = now + self.hold
+            admitted.append((slack_id, start))
+        return admitted
@@ -0,0 +1,234 @@
+# flake8: noqa E501
+"""
+*LabBot* - Long lived cloud API clients
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Shared keep-alive HTTP sessions for Digital Ocean and Cloudflare, cached
+credential validation, per provider rate limiting and call statistics.
+
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+from labbot.cloud.ratelimit import TokenBucket, PRIORITY_NORMAL
+from labbot.errors import LabCloudException
+from labbot import metrics
+
+CLOUD_POOL_SIZE = int(os.environ.get("CLOUD_POOL_SIZE", 32))
+CLOUD_VALIDATE_TTL = int(os.environ.get("CLOUD_VALIDATE_TTL", 300))
+CLOUD_RATE_RETRIES = int(os.environ.get("CLOUD_RATE_RETRIES", 8))
+CLOUD_RATE_BACKOFF = float(os.environ.get("CLOUD_RATE_BACKOFF", 5))
+
+# DO allows 250 requests a minute, Cloudflare 1200 every five minutes
+BUCKETS = {
+    "do": TokenBucket(
+        "do",
+        float(os.environ.get("DO_RATE", 250 / 60)),
+        int(os.environ.get("DO_BURST", 20)),
+    ),
+    "cf": TokenBucket(
+        "cf",
+        float(os.environ.get("CF_RATE", 1200 / 300)),
+        int(os.environ.get("CF_BURST", 20)),
+    ),
+}
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_do_session = None
+_cf_clients = dict()
+_validated = dict()
+_validating = dict()
+_stats = dict()
+
+
+def do_session():
+    """ requests Session shared by every python-digitalocean object """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _do_session
+    with _lock:
+        if _do_session is None:
+            _do_session = requests.Session()
+            _do_session.mount(
+                "https://",
+                HTTPAdapter(pool_connections=1, pool_maxsize=CLOUD_POOL_SIZE),
+            )
+            _do_session.hooks["response"].append(_do_ratelimit_hook)
+        return _do_session
+
+
+def _do_ratelimit_hook(response, *args, **kwargs):
+    BUCKETS["do"].observe(
+        response.headers.get("Ratelimit-Limit"),
+        response.headers.get("Ratelimit-Remaining"),
+        response.headers.get("Ratelimit-Reset"),
+    )
+    if response.status_code == 429:
+        BUCKETS["do"].backoff(
+            float(response.headers.get("Retry-After") or CLOUD_RATE_BACKOFF)
+        )
+
+
+def do_post(token, path, data):
+    """
+    POST data to the DO API path on the shared session, returns the JSON
+    reply. python-digitalocean sends POSTs with a bare requests.post, and
+    its create_multiple on a BaseAPI of its own, so neither would reach
+    the Ratelimit hook.
+    """
+    end_point = os.environ.get("DIGITALOCEAN_END_POINT", "https://api.digitalocean.com/v2/")
+    response = do_session().post(
+        end_point + path,
+        json=data,
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=60,
+    )
+    if response.status_code == 429:
+        raise LabCloudException(f"DO {path} too many requests")
+    if not response.ok:
+        try:
+            message = response.json().get("message")
+        except ValueError:
+            message = response.text
+        raise LabCloudException(f"DO {path} failed {response.status_code} {message}")
+    return response.json()
+
+
+def do_object(cls, token, **kwargs):
+    """ Build a python-digitalocean API object on the shared session """
+    return cls(token=token, _session=do_session(), **kwargs)
+
+
+def cf_client(email, token):
+    """ One long lived CloudFlare client per credential pair """
+    import CloudFlare
+
+    with _lock:
+        if (email, token) not in _cf_clients:
+            _cf_clients[(email, token)] = CloudFlare.CloudFlare(
+                debug=False, email=email, token=token
+            )
+        return _cf_clients[(email, token)]
+
+
+def validated(provider, check, ttl=CLOUD_VALIDATE_TTL):
+    """
+    Run check() at most once per ttl seconds for provider, only
+    successful validations are cached. Callers arriving while a check is
+    running wait on its result rather than running their own.
+    """
+    with _lock:
+        if _validated.get(provider, 0) > time.time():
+            return True
+        future = _validating.get(provider)
+        running = future is not None
+        if not running:
+            future = _validating[provider] = Future()
+    if running:
+        return future.result()
+
+    try:
+        ok = bool(check())
+    except Exception as e:
+        with _lock:
+            del _validating[provider]
+        future.set_exception(e)
+        raise
+    with _lock:
+        if ok:
+            _validated[provider] = time.time() + ttl
+        del _validating[provider]
+    future.set_result(ok)
+    return ok
+
+
+def invalidate(provider):
+    with _lock:
+        _validated.pop(provider, None)
+
+
+@contextmanager
+def timed(provider, operation):
+    """ Count and time one API call against provider """
+    _start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        _elapsed = time.time() - _start
+        with _lock:
+            s = _stats.setdefault(
+                provider, {"calls": 0, "errors": 0, "seconds": 0.0, "max": 0.0, "operations": {}}
+            )
+            s["calls"] += 1
+            s["errors"] += 0 if ok else 1
+            s["seconds"] += _elapsed
+            s["max"] = max(s["max"], _elapsed)
+            s["operations"][operation] = s["operations"].get(operation, 0) + 1
+        metrics.API_SECONDS.observe(_elapsed, provider, operation, str(ok).lower())
+        logger.debug(f"{provider} {operation} took {_elapsed:.3f}s ok={ok}")
+
+
+def _rate_limited(e):
+    """
+    DO surfaces a 429 as a generic API error, Cloudflare as an error
+    whose int() is 971 (throttled) or the HTTP status. Anything else,
+    authentication errors included, fails straight away.
+    """
+    import CloudFlare
+
+    if isinstance(e, CloudFlare.exceptions.CloudFlareAPIError) and int(e) in (971, 429):
+        return True
+    message = f"{e}".lower()
+    return "rate limit" in message or "too many requests" in message
+
+
+def api_call(provider, operation, fn, priority=PRIORITY_NORMAL):
+    """
+    Run fn() as one API call against provider, paced by the provider's
+    token bucket. Rate limited calls are queued again rather than failed.
+    """
+    bucket = BUCKETS[provider]
+    for attempt in range(CLOUD_RATE_RETRIES):
+        bucket.acquire(priority)
+        try:
+            with timed(provider, operation):
+                return fn()
+        except Exception as e:
+            if not _rate_limited(e):
+                raise
+            with _lock:
+                _stats[provider]["throttled"] = _stats[provider].get("throttled", 0) + 1
+            bucket.backoff(CLOUD_RATE_BACKOFF * 2 ** attempt)
+    raise LabCloudException(f"{provider} {operation} still rate limited after {CLOUD_RATE_RETRIES} attempts")
+
+
+metrics.gauge(
+    "labbot_api_queued",
+    "Calls waiting on a provider rate limit",
+    ("provider",),
+    lambda: {(provider,): b.depth() for provider, b in BUCKETS.items()},
+)
+
+
+def stats():
+    """ Snapshot of the per provider call counts and latencies """
+    with _lock:
+        return {
+            provider: dict(
+                s,
+                operations=dict(s["operations"]),
+                mean=s["seconds"] / s["calls"] if s["calls"] else 0.0,
+                queued=BUCKETS[provider].depth() if provider in BUCKETS else 0,
+            )
+            for provider, s in _stats.items()
+        }
@@ -9,8 +9,9 @@ Training / Presentation session virtual container management system
 """
 
 import os
-import CloudFlare
 import logging
+from labbot.cloud.clients import cf_client, api_call
+from labbot.cloud.ratelimit import PRIORITY_ADMIN, PRIORITY_POLL
 from labbot.errors import LabConfigMissing
 
 logger = logging.getLogger(__name__)
@@ -19,6 +20,7 @@ CF_API_KEY = os.environ.get("CF_API_KEY", None)
 CF_API_EMAIL = os.environ.get("CF_API_EMAIL", None)
 CF_ZONE = os.environ.get("CF_ZONE", None)
 CF_ZONE_PREFIX = os.environ.get("CF_ZONE_PREFIX", ".lab")
+CF_PAGE_SIZE = 100
 
 
 def check_config():
@@ -36,19 +38,58 @@ def check_config():
 def create_lab_a_record(reference, ip_address):
 
     check_config()
-    cf = CloudFlare.CloudFlare(debug=True, email=CF_API_EMAIL, token=CF_API_KEY)
+    cf = cf_client(CF_API_EMAIL, CF_API_KEY)
     record = {"name": reference + CF_ZONE_PREFIX, "type": "A", "content": ip_address, "ttl": 120}
-    r = cf.zones.dns_records.post(CF_ZONE, data=record)
+    r = api_call("cf", "create", lambda: cf.zones.dns_records.post(CF_ZONE, data=record))
     return (r.get("id"), r.get("name"))
 
 
 def delete_lab_a_record(record_id):
+    import CloudFlare
 
     try:
         check_config()
-        cf = CloudFlare.CloudFlare(debug=True, email=CF_API_EMAIL, token=CF_API_KEY)
-        r = cf.zones.dns_records.delete(CF_ZONE, record_id)
+        cf = cf_client(CF_API_EMAIL, CF_API_KEY)
+        r = api_call(
+            "cf", "delete", lambda: cf.zones.dns_records.delete(CF_ZONE, record_id), PRIORITY_ADMIN
+        )
         return r.get("id")
     except CloudFlare.exceptions.CloudFlareAPIError:
         logger.warn(f"CF record missing / already destroyed ? #{record_id}")
         return
+
+
+def is_lab_record(name):
+    """ True for records named <reference><CF_ZONE_PREFIX>.<zone> """
+    return name.partition(".")[2].startswith(CF_ZONE_PREFIX.lstrip(".") + ".")
+
+
+def list_lab_a_records():
+    """ Every lab A record in the zone, a page of CF_PAGE_SIZE per call """
+
+    check_config()
+    cf = cf_client(CF_API_EMAIL, CF_API_KEY)
+    records = []
+    page = 1
+    while True:
+        r = api_call(
+            "cf",
+            "list",
+            lambda: cf.zones.dns_records.get(
+                CF_ZONE, params={"type": "A", "per_page": CF_PAGE_SIZE, "page": page}
+            ),
+            PRIORITY_POLL,
+        )
+        records.extend(
+            {
+                "id": x.get("id"),
+                "name": x.get("name"),
+                "ip": x.get("content"),
+                "created_on": x.get("created_on"),
+            }
+            for x in r
+            if is_lab_record(x.get("name", ""))
+        )
+        if len(r) < CF_PAGE_SIZE:
+            return records
+        page += 1
@@ -9,92 +9,368 @@ Training / Presentation session virtual container management system
 """
 import os
 import sys
+import time
+import threading
 import traceback
 import logging
-import digitalocean
-import time
+# digitalocean is imported by the functions using it, loading the SDK
+# is a good share of start up time and most commands never need it
+from labbot.cloud.clients import do_object, do_post, validated, api_call
+from labbot.cloud.ratelimit import PRIORITY_ADMIN, PRIORITY_POLL
+from labbot.cloud.poller import DropletPoller, DO_TAG, DO_POLL_MIN
+from labbot.cloud.placement import RegionPlacer
+from labbot.phonehome import PhoneHome
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, wait
 from labbot.errors import LabCloudException, LabCloudTimeout
+from labbot import metrics
 
 DO_KEY = os.environ.get("DO_API_TOKEN", None)
-DO_ZONE = os.environ.get("DO_ZONE", "SFO2")
 DO_SIZE = os.environ.get("DO_SIZE", "s-1vcpu-3gb")
 DO_IMAGE = os.environ.get("DO_IMAGE", "ubuntu-18-04-x64")
-DO_TIMEOUT = os.environ.get("DO_TIMEOUT", 600)
+DO_TIMEOUT = int(os.environ.get("DO_TIMEOUT", 600))
+DO_SNAPSHOT_TIMEOUT = int(os.environ.get("DO_SNAPSHOT_TIMEOUT", 1800))
+DO_ACTION_POLL = float(os.environ.get("DO_ACTION_POLL", 10))
+# Most names DO accepts in one multi droplet create
+DO_BATCH_MAX = 10
+# A hedged create starts a second droplet once the first is slower than
+# this quantile of the last DO_HEDGE_WINDOW create to active times, or
+# than DO_HEDGE_AFTER seconds until DO_HEDGE_MIN_SAMPLES creates are timed
+DO_HEDGE_QUANTILE = float(os.environ.get("DO_HEDGE_QUANTILE", 0.9))
+DO_HEDGE_MIN_SAMPLES = int(os.environ.get("DO_HEDGE_MIN_SAMPLES", 20))
+DO_HEDGE_WINDOW = int(os.environ.get("DO_HEDGE_WINDOW", 100))
+DO_HEDGE_AFTER = float(os.environ.get("DO_HEDGE_AFTER", 120))
+# Carried by both droplets of a hedged create until one wins, unclaimed
+# ones are collected by the reconciler once their create has timed out
+DO_HEDGE_TAG = os.environ.get("DO_HEDGE_TAG", "labbot-hedge")
+
+_hedge_lock = threading.Lock()
+_hedges = {"launched": 0, "won": 0}
+_active_times = deque(maxlen=max(DO_HEDGE_WINDOW, 1))
 
 logger = logging.getLogger(__name__)
 
 
-def validate_key():
+def _check_key():
+    import digitalocean
     try:
-        _account = digitalocean.Account(token=DO_KEY)
-        _account.load()
+        _account = do_object(digitalocean.Account, DO_KEY)
+        api_call("do", "account", _account.load)
     except Exception:
         return False
 
     return True
 
 
-def create_instance(reference):
-    # from pudb import set_trace; set_trace()
+def validate_key():
+    return validated("do", _check_key)
+
+
+def _candidates(image, placer):
+    """ Regions a per region {region: image} may place in, None for any """
+    if isinstance(image, dict):
+        return [r for r in placer.regions if r in image] or None
+    return None
+
+
+def _image_for(image, region):
+    if isinstance(image, dict):
+        return image.get(region) or DO_IMAGE
+    return image or DO_IMAGE
+
+
+def _phone_home(references, tokens):
+    """ user_data calling back with {reference: token}, None if there are none """
+    if not any(tokens.get(reference) for reference in references):
+        return None
+    return PhoneHome().user_data(
+        {f"LabBot-{reference}": tokens.get(reference) for reference in references}
+    )
+
+
+def hedge_after():
+    """ Seconds a hedged create waits on its first droplet before starting another """
+    with _hedge_lock:
+        times = sorted(_active_times)
+    if len(times) < max(DO_HEDGE_MIN_SAMPLES, 1):
+        return DO_HEDGE_AFTER
+    rank = min(int(DO_HEDGE_QUANTILE * len(times)), len(times) - 1)
+    return min(times[rank], DO_TIMEOUT)
+
+
+def hedge_stats():
+    """ {"launched", "won"} counts of hedge droplets since start up """
+    with _hedge_lock:
+        return dict(_hedges)
+
+
+def _hedged(outcome):
+    with _hedge_lock:
+        _hedges[outcome] += 1
+
+
+def _timed(seconds):
+    """ Record one create to active time """
+    metrics.ACTIVE_SECONDS.observe(seconds)
+    with _hedge_lock:
+        _active_times.append(seconds)
+
+
+def _create(reference, tags, image, user_data, placer, candidates):
+    """
+    Request one droplet in the best of candidates, returns (droplet_id,
+    region, Future) with the Future from DropletPoller
+    """
+    import digitalocean
+
+    tried, error = [], None
+    while True:
+        _region = placer.choose(candidates, exclude=tried)
+        if _region is None:
+            raise LabCloudException(
+                f"Unhandled exception on droplet creation in {', '.join(tried)} {error}"
+            )
+        tried.append(_region)
+
+        try:
+            _droplet = do_object(
+                digitalocean.Droplet,
+                DO_KEY,
+                name=f"LabBot-{reference}",
+                region=_region,
+                image=_image_for(image, _region),
+                size_slug=DO_SIZE,
+                tags=[DO_TAG, reference] + tags,
+                user_data=user_data,
+            )
+
+            _start = time.time()
+            api_call("do", "create", _droplet.create)
+
+            logger.warn(f"New DO instance requested #{_droplet.id} in {_region}")
+
+            if _droplet.id is None:
+                raise LabCloudException(f"DO did not return an instance ID")
+        except Exception as e:
+            # Capacity or an outage in one region, try the next
+            traceback.print_exc(file=sys.stdout)
+            placer.failed(_region)
+            error = e
+            continue
+
+        # Wait for ready, the shared poller checks all droplets in one call
+        future = DropletPoller().register(_droplet.id, DO_TIMEOUT)
+        future.add_done_callback(
+            lambda f, region=_region, start=_start: _placed(f, placer, region, start, observe=False)
+        )
+        return _droplet.id, _region, future
+
+
+def _discard(droplet_id):
+    try:
+        destroy_instance(droplet_id)
+    except Exception as e:
+        # Still tagged, the reconciler collects it
+        logger.error(f"Destroying hedge loser #{droplet_id} failed {e}")
+
+
+def _keep(droplet_id):
+    try:
+        untag_instance(droplet_id, DO_HEDGE_TAG)
+    except Exception as e:
+        # Claimed by its lab once saved, the reconciler leaves it be
+        logger.error(f"Untagging hedge winner #{droplet_id} failed {e}")
+
+
+def create_instance(reference, tags=None, image=None, user_data=None, region=None, phone_home=None, hedge=False):
+    """
+    Create a droplet and wait for it to go active, returns (droplet_id, ip_address)
+
+    The region comes from RegionPlacer unless pinned with region, a create
+    the API refuses is retried in the next best region. image is either
+    one image for any region or {region: image}, which keeps the droplet
+    to those regions while any of them is configured. A PhoneHome token
+    in phone_home replaces user_data with the script that calls back.
+
+    With hedge a droplet not active after hedge_after() seconds gets a
+    twin, in another region if there is one. The first of them to go
+    active is used and the other destroyed straight away, the one used
+    loses DO_HEDGE_TAG.
+    """
 
     if not validate_key():
         raise LabCloudException("Unable to reach cloud API / Token issue")
 
-    try:
-        _droplet = digitalocean.Droplet(
-            token=DO_KEY,
-            name=f"LabBot-{reference}",
-            region=DO_ZONE,
-            image=DO_IMAGE,
-            size_slug=DO_SIZE,
-            tags=["labbot", reference],
-        )
+    if phone_home is not None:
+        # Twins share the name, so one script suits either
+        user_data = _phone_home([reference], {reference: phone_home})
+    tags = (tags or []) + ([DO_HEDGE_TAG] if hedge else [])
+
+    placer = RegionPlacer()
+    candidates = [region] if region is not None else _candidates(image, placer)
+    _start = time.time()
+    first_id, first_region, first = _create(reference, tags, image, user_data, placer, candidates)
+    droplets = {first: first_id}
+
+    if hedge and not wait([first], hedge_after()).done:
+        others = [r for r in (candidates or placer.regions) if r != first_region]
+        try:
+            twin_id, twin_region, twin = _create(
+                reference, tags, image, user_data, placer, others or [first_region]
+            )
+            droplets[twin] = twin_id
+            _hedged("launched")
+            logger.warn(
+                f"DO instance #{first_id} not active after {time.time() - _start:.0f}s, hedged with #{twin_id} in {twin_region}"
+            )
+        except LabCloudException as e:
+            logger.error(f"Hedging DO instance #{first_id} failed {e}")
+
+    winner, error, pending = None, None, set(droplets)
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+            elif winner is None:
+                winner = future
+
+    if len(droplets) > 1:
+        for future, droplet_id in droplets.items():
+            if future is winner:
+                continue
+            DropletPoller().cancel(droplet_id)
+            threading.Thread(
+                target=_discard, args=(droplet_id,), name="labbot-hedge", daemon=True
+            ).start()
+        if winner is not None and winner is not first:
+            _hedged("won")
+
+    if winner is None:
+        logger.error(f"DO instance creation for {reference} failed {error}")
+        if isinstance(error, LabCloudException):
+            raise error
+        raise LabCloudException(f"Unhandled exception on droplet creation {error}")
+
+    _timed(time.time() - _start)
+    if hedge:
+        threading.Thread(
+            target=_keep, args=(droplets[winner],), name="labbot-hedge", daemon=True
+        ).start()
+    return winner.result()
 
-        _droplet.create()
 
-        logger.warn(f"New DO instance requested #{_droplet.id}")
+def _placed(future, placer, region, start, observe=True):
+    if future.cancelled():
+        placer.cancelled(region)
+    elif future.exception() is None:
+        placer.done(region, time.time() - start)
+        if observe:
+            _timed(time.time() - start)
+    else:
+        placer.failed(region)
 
-        if _droplet.id is None:
-            raise LabCloudException(f"DO did not return an instance ID")
 
-        # Wait for ready
-        _start = time.time()
-        _waiting = True
-        while _waiting:
-            if time.time() - _start > DO_TIMEOUT:
-                raise LabCloudException("Timeout waiting for instance to be ready")
-            for action in _droplet.get_actions():
-                action.load()
-                logger.warn(f"Action = {action.type} {action.status}")
-                if action.type == "create" and action.status == "completed":
-                    _waiting = False
+def create_instances(references, tags=None, image=None, phone_home=None):
+    """
+    Create a droplet per reference, DO_BATCH_MAX to a create call
+
+    Returns {reference: Future} resolving to (droplet_id, ip_address)
+    like create_instance, the shared poller tracks the whole batch.
+    References are spread over regions by RegionPlacer first, a batch the
+    API refuses is retried whole in the next best region. phone_home is
+    {reference: PhoneHome token}, a batch shares one script that picks
+    each droplet's token by its name.
+    """
+
+    if not validate_key():
+        raise LabCloudException("Unable to reach cloud API / Token issue")
+
+    placer = RegionPlacer()
+    candidates = _candidates(image, placer)
+    by_region = dict()
+    for reference in references:
+        by_region.setdefault(placer.choose(candidates), []).append(reference)
+
+    batches = [
+        (region, placed[i : i + DO_BATCH_MAX])
+        for region, placed in by_region.items()
+        for i in range(0, len(placed), DO_BATCH_MAX)
+    ]
+
+    futures = dict()
+    for region, batch in batches:
+        tried = []
+        while True:
+            tried.append(region)
+            try:
+                _start = time.time()
+                # On the shared session, so DO's Ratelimit headers pace it
+                _droplets = api_call(
+                    "do",
+                    "create_multiple",
+                    lambda: do_post(
+                        DO_KEY,
+                        "droplets/",
+                        dict(
+                            names=[f"LabBot-{reference}" for reference in batch],
+                            region=region,
+                            image=_image_for(image, region),
+                            size=DO_SIZE,
+                            tags=[DO_TAG] + (tags or []),
+                            user_data=_phone_home(batch, phone_home or {}),
+                        ),
+                    )["droplets"],
+                )
+                logger.warn(f"New DO instances requested {[d['id'] for d in _droplets]} in {region}")
+                break
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                placer.failed(region, len(batch))
+                region = placer.choose(candidates, exclude=tried, count=len(batch))
+                if region is None:
+                    _droplets = e
                     break
-            time.sleep(5)
 
-        # Return instance details
-        _droplet.load()
-        return (_droplet.id, _droplet.ip_address)
+        if isinstance(_droplets, Exception):
+            for reference in batch:
+                futures[reference] = Future()
+                futures[reference].set_exception(
+                    LabCloudException(
+                        f"Unhandled exception on droplet creation in {', '.join(tried)} {_droplets}"
+                    )
+                )
+            continue
 
-    except LabCloudException:
-        traceback.print_exc(file=sys.stdout)
-        raise
-    except Exception as e:
-        traceback.print_exc(file=sys.stdout)
-        raise LabCloudException(f"Unhandled exception on droplet creation {e}")
+        by_name = {d["name"]: d["id"] for d in _droplets}
+        for reference in batch:
+            droplet_id = by_name.get(f"LabBot-{reference}")
+            if droplet_id is None:
+                placer.failed(region)
+                futures[reference] = Future()
+                futures[reference].set_exception(
+                    LabCloudException(f"DO did not return an instance ID for {reference}")
+                )
+            else:
+                futures[reference] = DropletPoller().register(droplet_id, DO_TIMEOUT)
+                futures[reference].add_done_callback(
+                    lambda f, region=region, start=_start: _placed(f, placer, region, start)
+                )
+
+    return futures
 
 
 def destroy_instance(reference):
+    import digitalocean
     # from pudb import set_trace; set_trace()
 
     if not validate_key():
         raise LabCloudException("Unable to reach cloud API / Token issue")
 
     try:
-        _droplet = digitalocean.Droplet.get_object(DO_KEY, reference)
-        if _droplet is None:
-            raise LabCloudException(f"Unable to get droplet object via API")
-
-        r = _droplet.destroy()
+        # No need to load the droplet first, destroy only needs the ID
+        _droplet = do_object(digitalocean.Droplet, DO_KEY, id=reference)
+        r = api_call("do", "destroy", _droplet.destroy, PRIORITY_ADMIN)
 
         logger.warn(f"DO instance destroyed #{r}")
 
@@ -109,3 +385,159 @@ def destroy_instance(reference):
     except Exception as e:
         traceback.print_exc(file=sys.stdout)
         raise LabCloudException(f"Unhandled exception on droplet destruction {e}")
+
+
+def _wait_action(action, timeout=DO_SNAPSHOT_TIMEOUT, poll=DO_ACTION_POLL):
+    deadline = time.time() + timeout
+    while action.status == "in-progress":
+        if time.time() > deadline:
+            raise LabCloudTimeout(f"DO action {action.type} #{action.id} timed out")
+        time.sleep(poll)
+        api_call("do", "action", action.load, PRIORITY_POLL)
+    if action.status != "completed":
+        raise LabCloudException(f"DO action {action.type} #{action.id} {action.status}")
+
+
+def rebuild_instance(reference, image=None):
+    """
+    Start reimaging droplet reference in place, its id and IP stay the
+    same, returns the rebuild action id for wait_rebuild(). image is as
+    for create_instance, the image for the droplet's region is used.
+    """
+    import digitalocean
+
+    if not validate_key():
+        raise LabCloudException("Unable to reach cloud API / Token issue")
+
+    try:
+        _droplet = do_object(digitalocean.Droplet, DO_KEY, id=reference)
+        api_call("do", "load", _droplet.load)
+        # DO_ZONES may be upper case, droplets report lower case slugs
+        slug = _droplet.region["slug"]
+        regions = image if isinstance(image, dict) else ()
+        region = next((r for r in regions if r.lower() == slug), slug)
+        action = api_call(
+            "do",
+            "rebuild",
+            lambda: _droplet.rebuild(_image_for(image, region), return_dict=False),
+        )
+        logger.warn(f"DO instance #{reference} rebuilding in {slug}, action #{action.id}")
+        return str(action.id)
+
+    except LabCloudException:
+        traceback.print_exc(file=sys.stdout)
+        raise
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        raise LabCloudException(f"Unhandled exception on droplet rebuild {e}")
+
+
+def wait_rebuild(reference, action_id):
+    """ Wait for droplet reference's rebuild action_id to finish booting it """
+    import digitalocean
+
+    try:
+        action = do_object(digitalocean.Action, DO_KEY, id=action_id, droplet_id=reference)
+        api_call("do", "action", action.load, PRIORITY_POLL)
+        _wait_action(action, DO_TIMEOUT, DO_POLL_MIN)
+        logger.warn(f"DO instance #{reference} rebuilt")
+
+    except (LabCloudException, LabCloudTimeout):
+        traceback.print_exc(file=sys.stdout)
+        raise
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        raise LabCloudException(f"Unhandled exception waiting on droplet rebuild {e}")
+
+
+def snapshot_instance(reference, name):
+    """ Power off droplet reference and snapshot it, returns the image id """
+    import digitalocean
+
+    try:
+        _droplet = do_object(digitalocean.Droplet, DO_KEY, id=reference)
+        _wait_action(
+            api_call("do", "power_off", lambda: _droplet.power_off(return_dict=False))
+        )
+        _wait_action(
+            api_call(
+                "do", "snapshot", lambda: _droplet.take_snapshot(name, return_dict=False)
+            )
+        )
+        api_call("do", "load", _droplet.load)
+        logger.warn(f"DO instance #{reference} snapshot {name} {_droplet.snapshot_ids}")
+        return str(_droplet.snapshot_ids[-1])
+
+    except (LabCloudException, LabCloudTimeout):
+        traceback.print_exc(file=sys.stdout)
+        raise
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        raise LabCloudException(f"Unhandled exception on droplet snapshot {e}")
+
+
+def destroy_image(reference):
+    import digitalocean
+
+    try:
+        _image = do_object(digitalocean.Image, DO_KEY, id=reference)
+        r = api_call("do", "destroy_image", _image.destroy, PRIORITY_ADMIN)
+        logger.warn(f"DO image destroyed #{reference}")
+        return r
+    except digitalocean.baseapi.NotFoundError:
+        logger.warn(f"DO image already destroyed? #{reference}")
+        return
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        raise LabCloudException(f"Unhandled exception on image destruction {e}")
+
+
+def tag_instance(reference, tag):
+    import digitalocean
+
+    try:
+        _tag = do_object(digitalocean.Tag, DO_KEY, name=tag)
+        api_call("do", "tag", _tag.create)
+        api_call("do", "tag", lambda: _tag.add_droplets([reference]))
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        raise LabCloudException(f"Unhandled exception tagging droplet {reference} {e}")
+
+
+def untag_instance(reference, tag):
+    import digitalocean
+
+    try:
+        _tag = do_object(digitalocean.Tag, DO_KEY, name=tag)
+        api_call("do", "untag", lambda: _tag.remove_droplets([reference]), PRIORITY_ADMIN)
+    except digitalocean.baseapi.NotFoundError:
+        logger.warn(f"DO tag {tag} missing / already removed ? #{reference}")
+        return
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        raise LabCloudException(f"Unhandled exception untagging droplet {reference} {e}")
+
+
+def list_instances():
+    """ Every droplet carrying the labbot tag, in one paginated list call """
+    import digitalocean
+
+    try:
+        _manager = do_object(digitalocean.Manager, DO_KEY)
+        _droplets = api_call(
+            "do", "list", lambda: _manager.get_all_droplets(tag_name=DO_TAG), PRIORITY_POLL
+        )
+        return [
+            {
+                "id": str(d.id),
+                "name": d.name,
+                "ip": d.ip_address,
+                "status": d.status,
+                "tags": d.tags,
+                "created_at": d.created_at,
+            }
+            for d in _droplets
+        ]
+    except Exception as e:
+        traceback.print_exc(file=sys.stdout)
+        raise LabCloudException(f"Unhandled exception listing droplets {e}")
@@ -0,0 +1,166 @@
+# flake8: noqa E501
+"""
+*LabBot* - Droplet region placement
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Picks the region for each new droplet from DO_ZONES by how quickly our
+own creates there have been going active, how often they fail and how
+many are already on their way up.
+
+"""
+
+import os
+import time
+import logging
+import threading
+from labbot.singleton import Singleton
+from labbot import metrics
+
+DO_ZONE = os.environ.get("DO_ZONE", "SFO2")
+DO_ZONES = [z.strip() for z in os.environ.get("DO_ZONES", DO_ZONE).split(",") if z.strip()]
+# Assumed create to active seconds for a region we have not used yet
+PLACEMENT_PRIOR = float(os.environ.get("DO_PLACEMENT_PRIOR", 60))
+# Weight of the newest sample in the latency average
+PLACEMENT_ALPHA = float(os.environ.get("DO_PLACEMENT_ALPHA", 0.3))
+# Seconds a region's failure rate decays by half over
+PLACEMENT_HALF_LIFE = float(os.environ.get("DO_PLACEMENT_HALF_LIFE", 15 * 60))
+# Seconds added to a region's score at a 100% failure rate
+PLACEMENT_FAILURE_PENALTY = float(os.environ.get("DO_PLACEMENT_FAILURE_PENALTY", 600))
+# Droplets in flight it takes to double a region's expected latency
+PLACEMENT_SPREAD = float(os.environ.get("DO_PLACEMENT_SPREAD", 5))
+
+logger = logging.getLogger(__name__)
+
+
+class _Region(object):
+    def __init__(self, name):
+        self.name = name
+        self.latency = None
+        self.ok = 0.0
+        self.failed = 0.0
+        self.inflight = 0
+        self.updated = time.time()
+
+    def decay(self, now):
+        factor = 0.5 ** ((now - self.updated) / PLACEMENT_HALF_LIFE)
+        self.ok *= factor
+        self.failed *= factor
+        self.updated = now
+
+    def failure_rate(self):
+        # One phantom success keeps a single failure from writing a region off
+        return self.failed / (self.ok + self.failed + 1)
+
+    def score(self):
+        """ Expected seconds to active for one more droplet here """
+        latency = self.latency if self.latency is not None else PLACEMENT_PRIOR
+        return (
+            latency * (1 + self.inflight / PLACEMENT_SPREAD)
+            + self.failure_rate() * PLACEMENT_FAILURE_PENALTY
+        )
+
+
+class RegionPlacer(object, metaclass=Singleton):
+    """
+    Singleton scoring DO_ZONES for new droplets
+
+    choose() hands out the best region and counts its droplets in flight
+    there, each of them must be followed by done(), failed() or
+    cancelled() for the same region. In flight droplets raise a region's
+    score, so a burst is spread over the regions rather than all landing
+    on the fastest.
+    """
+
+    def __init__(self, regions=DO_ZONES):
+        self._lock = threading.Lock()
+        self._regions = {name: _Region(name) for name in regions}
+
+    @property
+    def regions(self):
+        return list(self._regions)
+
+    def choose(self, candidates=None, exclude=(), count=1):
+        """
+        Best region of candidates (default all) not in exclude for count
+        droplets, None if none are left. Candidates outside DO_ZONES are
+        tracked from their first use, they only come up when asked for.
+        """
+        now = time.time()
+        with self._lock:
+            for name in candidates or ():
+                self._regions.setdefault(name, _Region(name))
+            regions = [
+                r
+                for name, r in self._regions.items()
+                if (candidates is None or name in candidates) and name not in exclude
+            ]
+            if not regions:
+                return None
+            for r in regions:
+                r.decay(now)
+            # Ties go to the earliest configured region
+            best = min(regions, key=lambda r: r.score())
+            best.inflight += count
+            return best.name
+
+    def done(self, region, seconds):
+        """ A droplet in region went active seconds after its create call """
+        with self._lock:
+            r = self._regions[region]
+            r.decay(time.time())
+            r.inflight -= 1
+            r.ok += 1
+            r.latency = (
+                seconds
+                if r.latency is None
+                else PLACEMENT_ALPHA * seconds + (1 - PLACEMENT_ALPHA) * r.latency
+            )
+
+    def cancelled(self, region):
+        """ A droplet in region was given up on before it went active, not its fault """
+        with self._lock:
+            self._regions[region].inflight -= 1
+
+    def failed(self, region, count=1):
+        """ count droplets in region failed to create or never went active """
+        with self._lock:
+            r = self._regions[region]
+            r.decay(time.time())
+            r.inflight -= count
+            r.failed += count
+        logger.warn(f"Droplet placement in {region} failed ({count})")
+
+    def stats(self):
+        """ {region: {"latency", "failure_rate", "inflight", "score"}} """
+        now = time.time()
+        with self._lock:
+            for r in self._regions.values():
+                r.decay(now)
+            return {
+                name: {
+                    "latency": r.latency,
+                    "failure_rate": r.failure_rate(),
+                    "inflight": r.inflight,
+                    "score": r.score(),
+                }
+                for name, r in self._regions.items()
+            }
+
+
+metrics.gauge(
+    "labbot_region_active_seconds",
+    "Average create to active time of recent droplets per region",
+    ("region",),
+    lambda: {
+        (region,): s["latency"]
+        for region, s in RegionPlacer().stats().items()
+        if s["latency"] is not None
+    },
+)
+metrics.gauge(
+    "labbot_region_inflight",
+    "Droplets created and not yet active per region",
+    ("region",),
+    lambda: {(region,): s["inflight"] for region, s in RegionPlacer().stats().items()},
+)
@@ -0,0 +1,117 @@
+# flake8: noqa E501
+"""
+*LabBot* - Shared Digital Ocean droplet readiness poller
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Training / Presentation session virtual container management system
+
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+from concurrent.futures import Future
+from labbot.singleton import Singleton
+from labbot.cloud.clients import do_object, api_call
+from labbot.cloud.ratelimit import PRIORITY_POLL
+from labbot.errors import LabCloudException
+
+DO_KEY = os.environ.get("DO_API_TOKEN", None)
+DO_TAG = os.environ.get("DO_TAG", "labbot")
+DO_POLL_MIN = float(os.environ.get("DO_POLL_MIN", 2))
+DO_POLL_MAX = float(os.environ.get("DO_POLL_MAX", 15))
+
+logger = logging.getLogger(__name__)
+
+
+class DropletPoller(object, metaclass=Singleton):
+    """
+    Singleton that waits on many droplets with one list-by-tag call per tick
+
+    register() returns a Future resolving to (droplet_id, ip_address) once
+    the droplet is active, or raising LabCloudException on timeout.
+    """
+
+    def __init__(self, min_interval=DO_POLL_MIN, max_interval=DO_POLL_MAX):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = dict()
+        self._thread = threading.Thread(
+            target=self._run, name="labbot-do-poller", daemon=True
+        )
+        self._thread.start()
+
+    def register(self, droplet_id, timeout):
+        future = Future()
+        with self._lock:
+            self._pending[int(droplet_id)] = (future, time.time() + timeout)
+        # New work, poll promptly again
+        self.interval = self.min_interval
+        self._wakeup.set()
+        return future
+
+    def cancel(self, droplet_id):
+        """ Stop waiting on droplet_id, its future is cancelled """
+        with self._lock:
+            future, _ = self._pending.pop(int(droplet_id), (None, None))
+        if future is not None:
+            future.cancel()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            with self._lock:
+                if not self._pending:
+                    continue
+            self._tick()
+
+    def _tick(self):
+        import digitalocean
+
+        try:
+            _manager = do_object(digitalocean.Manager, DO_KEY)
+            _droplets = api_call(
+                "do", "list", lambda: _manager.get_all_droplets(tag_name=DO_TAG), PRIORITY_POLL
+            )
+        except Exception as e:
+            # Still fall through so waiters time out on schedule
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Droplet poll failed {e}")
+            _droplets = []
+        ready = {
+            int(d.id): d.ip_address
+            for d in _droplets
+            if d.status == "active" and d.ip_address
+        }
+
+        resolved = 0
+        now = time.time()
+        with self._lock:
+            for droplet_id, (future, deadline) in list(self._pending.items()):
+                if droplet_id in ready:
+                    future.set_result((droplet_id, ready[droplet_id]))
+                elif deadline < now:
+                    future.set_exception(
+                        LabCloudException("Timeout waiting for instance to be ready")
+                    )
+                else:
+                    continue
+                resolved += 1
+                del self._pending[droplet_id]
+            waiting = len(self._pending)
+
+        logger.debug(f"Droplet poll, {resolved} resolved, {waiting} waiting")
+
+        # Back off while nothing is changing, stay quick while droplets come up
+        if resolved:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 1.5, self.max_interval)
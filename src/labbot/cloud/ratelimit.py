@@ -0,0 +1,98 @@
+# flake8: noqa E501
+"""
+*LabBot* - Per provider API rate limiting
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Token buckets that pace cloud API calls by priority, and slow down or
+pause when the provider says we are close to, or over, its limit.
+
+"""
+
+import heapq
+import logging
+import itertools
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first
+PRIORITY_ADMIN = 0
+PRIORITY_NORMAL = 10
+PRIORITY_POLL = 20
+
+# Start slowing down once less than this fraction of the window is left
+LOW_WATER = 0.1
+
+
+class TokenBucket(object):
+    """
+    rate tokens per second up to burst, handed out to waiters in
+    (priority, arrival) order
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.default_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.time()
+        self._paused_until = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        """ Block until this caller may make one request, returns the wait """
+        _start = time.time()
+        ticket = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            while True:
+                now = time.time()
+                self._refill(now)
+                if self._waiters[0] == ticket and now >= self._paused_until:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        heapq.heappop(self._waiters)
+                        self._cond.notify_all()
+                        return time.time() - _start
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = max(self._paused_until - now, 0) or None
+                self._cond.wait(wait)
+
+    def observe(self, limit, remaining, reset):
+        """
+        Feed back the provider's rate limit headers, reset being the epoch
+        time the window refills
+        """
+        try:
+            limit, remaining, reset = int(limit), int(remaining), float(reset)
+        except (TypeError, ValueError):
+            return
+        with self._cond:
+            if remaining < limit * LOW_WATER:
+                # Spread what is left over the rest of the window
+                self.rate = max(remaining, 1) / max(reset - time.time(), 1)
+                logger.warn(f"{self.name} rate limit low ({remaining}/{limit}), pacing at {self.rate:.2f}/s")
+            else:
+                self.rate = self.default_rate
+
+    def backoff(self, seconds):
+        """ Provider said no, hold every caller for seconds """
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._tokens = 0
+            self._cond.notify_all()
+        logger.warn(f"{self.name} rate limited, pausing {seconds:.1f}s")
+
+    def depth(self):
+        with self._cond:
+            return len(self._waiters)
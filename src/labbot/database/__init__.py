@@ -1,2 +1,5 @@
 from .db import DB, DeclarativeBase
-from .lab_model import Lab, LabStatus
+from .lab_model import Lab, LabArchive, LabStatus
+from .job_model import LabJob, JobKind, JobStatus
+from .image_model import LabImage, ImageStatus
+from .lock_model import LabLock
@@ -1,11 +1,16 @@
+import hashlib
 import logging
 import os
+import time
+import threading
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from concurrent.futures import Future
+from sqlalchemy import create_engine, event, exc, select, Table, Column, String
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
-from alembic.config import Config
-from alembic import command
+from labbot.version import __version__
 
 __all__ = ["DB", "DeclarativeBase"]
 
@@ -13,6 +18,38 @@ logger = logging.getLogger(__name__)
 
 DeclarativeBase = declarative_base()
 
+DB_POOL_SIZE = int(os.getenv("LABBOT_DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("LABBOT_DB_MAX_OVERFLOW", 20))
+DB_BUSY_TIMEOUT = float(os.getenv("LABBOT_DB_BUSY_TIMEOUT", 30))
+# How long the writer waits for more writes to share a commit with
+DB_WRITE_WINDOW = float(os.getenv("LABBOT_DB_WRITE_WINDOW", 0.02))
+
+# Fingerprint of the schema create_all last ran for
+_schema = Table(
+    "labbot_schema",
+    DeclarativeBase.metadata,
+    Column("fingerprint", String(40), primary_key=True),
+)
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers carry on while a write commits
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+    cursor.close()
+
+
+def _schema_fingerprint():
+    """ Hash of the bot version and every table, column and index it expects """
+    parts = [__version__]
+    for table in DeclarativeBase.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f"{c.name}:{c.type!r}:{c.nullable}" for c in table.columns)
+        parts.extend(sorted(i.name for i in table.indexes))
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
 
 class Singleton(type):
     _instances = {}
@@ -32,11 +69,97 @@ class DB(object, metaclass=Singleton):
         self.db_url = (
             db_url if db_url else os.getenv("LABBOT_DB_URL", "sqlite:///labbot.db")
         )
-        self.engine = create_engine(self.db_url, pool_recycle=3600)
-        self.Session = sessionmaker(bind=self.engine)
+        self.engine = self._create_engine(self.db_url)
+        # Objects stay readable after their short lived session is gone
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self._writes = []
+        self._writes_cond = threading.Condition()
+        self._writer = None
+        self._ensure_schema()
+
+    def _ensure_schema(self):
+        """
+        Run create_all only when the schema changed since it last ran,
+        a restart on the same version costs a single query
+        """
+        fingerprint = _schema_fingerprint()
+        try:
+            with self.engine.connect() as conn:
+                if conn.execute(select([_schema.c.fingerprint])).scalar() == fingerprint:
+                    return
+        except exc.DBAPIError:
+            # First start, the table is made by create_all below
+            pass
+        logger.info(f"Checking database schema for {__version__}")
         DeclarativeBase.metadata.create_all(self.engine)
-        # alembic_cfg = Config("alembic.ini")
-        # command.stamp(alembic_cfg, "head")
+        with self.engine.begin() as conn:
+            conn.execute(_schema.delete())
+            conn.execute(_schema.insert().values(fingerprint=fingerprint))
+
+    @staticmethod
+    def _create_engine(db_url):
+        url = make_url(db_url)
+        if url.drivername.startswith("sqlite"):
+            if url.database in (None, "", ":memory:"):
+                # One connection is the whole in memory database
+                return create_engine(db_url)
+            engine = create_engine(
+                db_url,
+                poolclass=QueuePool,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                connect_args={"timeout": DB_BUSY_TIMEOUT, "check_same_thread": False},
+            )
+            event.listen(engine, "connect", _sqlite_pragmas)
+            return engine
+        return create_engine(
+            db_url,
+            pool_recycle=3600,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+
+    def write(self, fn):
+        """
+        Run fn(session) in the writer's next transaction and return its
+        result once committed. Concurrent writes share one commit.
+        """
+        future = Future()
+        with self._writes_cond:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name="labbot-db-writer", daemon=True
+                )
+                self._writer.start()
+            self._writes.append((fn, future))
+            self._writes_cond.notify()
+        return future.result()
+
+    def _write_loop(self):
+        while True:
+            with self._writes_cond:
+                while not self._writes:
+                    self._writes_cond.wait()
+            time.sleep(DB_WRITE_WINDOW)
+            with self._writes_cond:
+                batch, self._writes = self._writes, []
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with self.session() as s:
+                results = [fn(s) for fn, _ in batch]
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Run them one by one so only the bad write fails
+            for write in batch:
+                self._commit([write])
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
 
     @contextmanager
     def session(self):
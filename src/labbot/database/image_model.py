@@ -0,0 +1,40 @@
+import enum
+import datetime
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Sequence,
+    DateTime,
+    Enum,
+)
+from .db import DeclarativeBase
+
+__all__ = ["LabImage", "ImageStatus"]
+
+
+class ImageStatus(enum.Enum):
+    BUILDING = 10
+    READY = 20
+    FAILED = 30
+    RETIRED = 40
+
+
+class LabImage(DeclarativeBase):
+    """
+    Pre-baked lab snapshots, new labs boot from the newest READY one
+    """
+
+    __tablename__ = "lab_images"
+
+    id = Column(Integer, Sequence("lab_image_id_seq"), primary_key=True)
+    version = Column(Integer(), nullable=False)
+    region = Column(String(16), index=True)
+    snapshot_id = Column(String(255))
+    status = Column(Enum(ImageStatus), default=ImageStatus.BUILDING, index=True)
+    error = Column(String(255))
+    ts_created = Column(DateTime, default=datetime.datetime.now)
+    ts_updated = Column(DateTime, onupdate=datetime.datetime.now)
+
+    def __repr__(self):
+        return f"<LabImage({self.id}:v{self.version} {self.region} {self.snapshot_id} {self.status})"
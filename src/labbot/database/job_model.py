@@ -0,0 +1,46 @@
+import enum
+import datetime
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    Sequence,
+    DateTime,
+    Enum,
+)
+from .db import DeclarativeBase
+
+__all__ = ["LabJob", "JobKind", "JobStatus"]
+
+
+class JobKind(enum.Enum):
+    CREATE = 10
+    DESTROY = 20
+    DESTROY_ALL = 30
+    RESET = 40
+
+
+class JobStatus(enum.Enum):
+    QUEUED = 10
+    RUNNING = 20
+    DONE = 30
+    FAILED = 40
+
+
+class LabJob(DeclarativeBase):
+    __tablename__ = "lab_jobs"
+
+    id = Column(Integer, Sequence("lab_job_id_seq"), primary_key=True)
+    kind = Column(Enum(JobKind), nullable=False)
+    slack_id = Column(String(22), index=True)
+    status = Column(Enum(JobStatus), default=JobStatus.QUEUED, index=True)
+    attempts = Column(Integer(), default=0)
+    error = Column(String(255))
+    ts_created = Column(DateTime, default=datetime.datetime.now)
+    ts_updated = Column(DateTime, onupdate=datetime.datetime.now)
+    # Replica running or holding the job and until when, see labbot.lease
+    lease_owner = Column(String(64))
+    lease_expires = Column(DateTime)
+
+    def __repr__(self):
+        return f"<LabJob({self.id}:{self.kind} {self.slack_id} {self.status})"
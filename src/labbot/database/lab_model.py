@@ -12,12 +12,15 @@ from sqlalchemy import (
 )
 from .db import DeclarativeBase
 
-__all__ = ["Lab", "LabStatus"]
+__all__ = ["Lab", "LabArchive", "LabStatus"]
 
 
 class LabStatus(enum.Enum):
     UNKNOWN = 0
     PENDING = 10
+    POOL_WAITING_INSTANCE = 12
+    POOL_WAITING_HEALTH = 14
+    POOL_READY = 16
     WAITING_INSTANCE = 20
     WAITING_DNS = 30
     WAITING_HEALTH = 35
@@ -29,18 +32,62 @@ class LabStatus(enum.Enum):
 
 class Lab(DeclarativeBase):
     __tablename__ = "labs"
+    # Ids must never be reused once a lab is moved to the archive
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, Sequence("file_id_seq"), primary_key=True)
-    slack_owner_id = Column(String(22))
+    # One live lab per owner, pool labs have none
+    slack_owner_id = Column(String(22), index=True, unique=True)
     url = Column(String(255))
     ip = Column(String(16))
     do_reference = Column(String(255))
     cf_reference = Column(String(255))
     active = Column(Boolean, default=True)
-    status = Column(Enum(LabStatus), default=LabStatus.UNKNOWN)
+    status = Column(Enum(LabStatus), default=LabStatus.UNKNOWN, index=True)
     instances = Column(Integer(), default=0)
     ts_created = Column(DateTime, default=datetime.datetime.now)
     ts_updated = Column(DateTime, onupdate=datetime.datetime.now)
+    ts_expires = Column(DateTime)
+    # DO rebuild action a reset lab waits on before its health check
+    do_action = Column(String(32))
+    # Replica working on the lab and until when, see labbot.lease
+    lease_owner = Column(String(64))
+    lease_expires = Column(DateTime)
 
     def __repr__(self):
         return f"<Lab({self.id}:{self.slack_owner_id} {self.ip} {self.url})"
+
+
+class LabArchive(DeclarativeBase):
+    """
+    Terminated labs, kept out of the labs table so it only holds live ones
+    """
+
+    __tablename__ = "labs_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    slack_owner_id = Column(String(22), index=True)
+    url = Column(String(255))
+    ip = Column(String(16))
+    do_reference = Column(String(255))
+    cf_reference = Column(String(255))
+    active = Column(Boolean, default=False)
+    status = Column(Enum(LabStatus), default=LabStatus.TERMINATED)
+    instances = Column(Integer(), default=0)
+    ts_created = Column(DateTime)
+    ts_updated = Column(DateTime)
+    ts_expires = Column(DateTime)
+    ts_archived = Column(DateTime, default=datetime.datetime.now)
+
+    @classmethod
+    def from_lab(cls, lab):
+        return cls(
+            **{
+                c.name: getattr(lab, c.name)
+                for c in Lab.__table__.columns
+                if c.name in cls.__table__.columns
+            }
+        )
+
+    def __repr__(self):
+        return f"<LabArchive({self.id}:{self.slack_owner_id} {self.status})"
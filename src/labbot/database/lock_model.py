@@ -0,0 +1,23 @@
+from sqlalchemy import (
+    Column,
+    String,
+    DateTime,
+)
+from .db import DeclarativeBase
+
+__all__ = ["LabLock"]
+
+
+class LabLock(DeclarativeBase):
+    """
+    Named locks shared by every bot replica, leased like labs and jobs
+    """
+
+    __tablename__ = "lab_locks"
+
+    name = Column(String(32), primary_key=True)
+    lease_owner = Column(String(64))
+    lease_expires = Column(DateTime)
+
+    def __repr__(self):
+        return f"<LabLock({self.name} {self.lease_owner} {self.lease_expires})"
@@ -14,3 +14,9 @@ class LabCloudTimeout(Exception):
 
 class LabConfigMissing(Exception):
     pass
+
+class LabNotReady(Exception):
+    pass
+
+class LabQueued(Exception):
+    pass
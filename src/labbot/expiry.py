@@ -0,0 +1,143 @@
+# flake8: noqa E501
+"""
+*LabBot* - Lab expiry scheduler
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Keeps a min-heap of lab deadlines and only wakes when the next warning
+or expiry is due.
+
+"""
+
+import os
+import sys
+import heapq
+import logging
+import itertools
+import threading
+import traceback
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_WARNING = int(os.environ.get("LAB_EXPIRY_WARNING", 10 * 60))
+# Seconds until a lab whose expiry teardown failed is tried again
+EXPIRY_RETRY = int(os.environ.get("LAB_EXPIRY_RETRY", 60))
+
+WARN = "warn"
+EXPIRE = "expire"
+
+
+class ExpiryScheduler(object):
+    """
+    Tears labs down once their ts_expires passes, warning the owner first
+
+    Heap entries are never removed in place, an entry whose deadline no
+    longer matches the lab's current one is stale and skipped when popped.
+    Every replica keeps the heap, only the leader acts on it.
+    """
+
+    def __init__(self, manager, callback_factory=None, warning=EXPIRY_WARNING):
+        self.manager = manager
+        self.callback_factory = callback_factory
+        self.warning = warning
+        self._heap = []
+        self._deadlines = dict()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="labbot-expiry", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Expiry scheduler started with {len(self._deadlines)} labs")
+
+    def schedule(self, key, slack_id, expires):
+        """ (Re)schedule lab key to expire at the datetime expires """
+        deadline = expires.timestamp()
+        with self._cond:
+            self._deadlines[key] = (slack_id, deadline)
+            if deadline - self.warning > time.time():
+                self._push(deadline - self.warning, key, WARN, deadline)
+            self._push(deadline, key, EXPIRE, deadline)
+            self._cond.notify()
+
+    def retry(self, key, slack_id):
+        """ Expire lab key again in EXPIRY_RETRY seconds, its teardown failed """
+        self.schedule(key, slack_id, datetime.fromtimestamp(time.time() + EXPIRY_RETRY))
+
+    def cancel(self, key):
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def expires(self, key):
+        with self._cond:
+            return self._deadlines.get(key, (None, None))[1]
+
+    def _push(self, due, key, kind, deadline):
+        heapq.heappush(self._heap, (due, next(self._seq), key, kind, deadline))
+
+    def _due(self):
+        """ Pop every live entry that is due, sleeping until there is one """
+        with self._cond:
+            while True:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(
+                        self._heap[0][0] - time.time() if self._heap else None
+                    )
+                due = []
+                while self._heap and self._heap[0][0] <= time.time():
+                    _, _, key, kind, deadline = heapq.heappop(self._heap)
+                    if self._deadlines.get(key, (None, None))[1] == deadline:
+                        due.append((self._deadlines[key][0], key, kind))
+                if due:
+                    return due
+
+    def _run(self):
+        while True:
+            due = self._due()
+            if not self.manager.is_leader():
+                continue
+            try:
+                for slack_id, key, kind in due:
+                    if kind == WARN:
+                        self.notify(
+                            slack_id,
+                            f"Your lab expires in {int(self.warning / 60)} minutes, use 'extendlab' to keep it",
+                        )
+                expired = [(slack_id, key) for slack_id, key, kind in due if kind == EXPIRE]
+                if expired:
+                    # Tear the batch down off the scheduler thread
+                    threading.Thread(
+                        target=self._expire, args=(expired,), daemon=True
+                    ).start()
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Expiry scheduler error {e}")
+
+    def _expire(self, expired):
+        logger.info(f"Expiring {len(expired)} labs")
+        try:
+            self.manager.expire_labs([slack_id for slack_id, key in expired])
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Lab expiry failed {e}")
+            # Popped off the heap, nothing else would try them again
+            for slack_id, key in expired:
+                self.retry(key, slack_id)
+
+    def notify(self, slack_id, message):
+        if self.callback_factory is None or slack_id is None:
+            return
+        try:
+            callback = self.callback_factory(slack_id)
+            next(callback)
+            callback.send(message)
+            callback.close()
+        except Exception as e:
+            logger.warn(f"Unable to notify {slack_id} {e}")
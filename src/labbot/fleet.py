@@ -0,0 +1,88 @@
+# flake8: noqa E501
+"""
+*LabBot* - Copy on write lab fleet snapshot
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+LabManager publishes a new FleetView on every lab transition and queue
+change, status commands read the latest one without list_lock or the DB.
+
+"""
+
+from collections import namedtuple
+
+__all__ = ["FleetSnapshot", "FleetView", "LabView"]
+
+# since is when the lab entered its status, expires is set for active labs
+LabView = namedtuple("LabView", "key owner status since url expires")
+
+
+class FleetView(namedtuple("FleetView", "labs owners counts queue places")):
+    """
+    One published snapshot, its dicts are never changed once it is out
+
+    labs {key: LabView}, owners {slack_id: key}, counts {status: n},
+    queue the owners waiting for a slot in order, places {slack_id: n}.
+    """
+
+    def lab(self, owner):
+        """ LabView of owner's lab, or None """
+        key = self.owners.get(owner)
+        return None if key is None else self.labs[key]
+
+    def count(self, *statuses):
+        return sum(self.counts.get(status, 0) for status in statuses)
+
+    def position(self, owner):
+        """ 1 based place in line, None if not waiting """
+        return self.places.get(owner)
+
+
+class FleetSnapshot(object):
+    """
+    Latest FleetView, every change publishes a new one built from copies
+    of the last. Writers hold LabManager.list_lock, view() never blocks.
+    """
+
+    def __init__(self):
+        self._view = FleetView(dict(), dict(), dict(), (), dict())
+
+    def view(self):
+        return self._view
+
+    def put(self, lab):
+        """ Publish lab (a LabView) as added or changed """
+        view = self._view
+        labs, owners, counts = dict(view.labs), dict(view.owners), dict(view.counts)
+        old = labs.get(lab.key)
+        if old is not None:
+            self._forget(old, owners, counts)
+        labs[lab.key] = lab
+        if lab.owner is not None:
+            owners[lab.owner] = lab.key
+        counts[lab.status] = counts.get(lab.status, 0) + 1
+        self._view = view._replace(labs=labs, owners=owners, counts=counts)
+
+    def remove(self, key):
+        view = self._view
+        if key not in view.labs:
+            return
+        labs, owners, counts = dict(view.labs), dict(view.owners), dict(view.counts)
+        self._forget(labs.pop(key), owners, counts)
+        self._view = view._replace(labs=labs, owners=owners, counts=counts)
+
+    def queue(self, owners):
+        """ Publish the admission line, owners in order """
+        owners = tuple(owners)
+        if owners == self._view.queue:
+            return
+        places = {owner: i for i, owner in enumerate(owners, 1)}
+        self._view = self._view._replace(queue=owners, places=places)
+
+    @staticmethod
+    def _forget(lab, owners, counts):
+        if lab.owner is not None and owners.get(lab.owner) == lab.key:
+            del owners[lab.owner]
+        counts[lab.status] -= 1
+        if not counts[lab.status]:
+            del counts[lab.status]
@@ -0,0 +1,228 @@
+# flake8: noqa E501
+"""
+*LabBot* - Pre-baked lab images
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Builds lab snapshots from a reference droplet so new labs only have to
+boot, not install the lab software.
+
+"""
+
+import os
+import sys
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+from labbot.database import LabImage, ImageStatus
+from labbot.prober import HealthProber
+from labbot.cloud.placement import DO_ZONE
+from labbot.cloud.do import (
+    DO_TIMEOUT,
+    DO_SNAPSHOT_TIMEOUT,
+    create_instance,
+    destroy_instance,
+    snapshot_instance,
+    destroy_image,
+)
+
+logger = logging.getLogger(__name__)
+
+IMAGE_TAG = os.environ.get("LAB_IMAGE_TAG", "labbot-image")
+IMAGE_KEEP = int(os.environ.get("LAB_IMAGE_KEEP", 2))
+IMAGE_HEALTH_TIMEOUT = float(os.environ.get("LAB_IMAGE_HEALTH_TIMEOUT", 30 * 60))
+# A build still going after this long died with its replica, its
+# reference droplet and BUILDING row are cleaned up
+IMAGE_BUILD_GRACE = float(
+    os.environ.get(
+        "LAB_IMAGE_BUILD_GRACE", DO_TIMEOUT + IMAGE_HEALTH_TIMEOUT + DO_SNAPSHOT_TIMEOUT + 10 * 60
+    )
+)
+# A superseded image is kept until its successor has been ready this
+# long, so every replica has synced past it before its snapshot goes
+IMAGE_PRUNE_GRACE = float(os.environ.get("LAB_IMAGE_PRUNE_GRACE", 10 * 60))
+# cloud-init script that installs the lab on the stock DO_IMAGE
+IMAGE_USER_DATA = os.environ.get("LAB_IMAGE_USER_DATA", None)
+
+
+class ImageManager(object):
+    """
+    current(region) is the snapshot id new labs in region should boot
+    from, or None to fall back to DO_IMAGE when no image has been built
+    there, which it also is until load() has run. region defaults to the
+    one images are built in. Other replicas' builds are picked up by
+    refresh(), which LabManager runs on every sync.
+    """
+
+    def __init__(self, db, region=DO_ZONE):
+        self.db = db
+        self.region = region
+        self._current = dict()
+        self._build_lock = threading.Lock()
+
+    def load(self):
+        """ Fail interrupted builds and make the newest ready images current """
+        self.fail_stale()
+        self.refresh()
+
+    def refresh(self):
+        """ Make the newest ready image of every region current """
+        with self.db.session() as s:
+            images = (
+                s.query(LabImage)
+                .filter(LabImage.status == ImageStatus.READY)
+                .order_by(LabImage.version.desc())
+                .all()
+            )
+        current = dict()
+        for image in images:
+            current.setdefault(image.region, (image.version, image.snapshot_id))
+        self._current = current
+
+    def fail_stale(self):
+        """ Mark builds that outlived IMAGE_BUILD_GRACE failed, their replica went away """
+        cutoff = datetime.now() - timedelta(seconds=IMAGE_BUILD_GRACE)
+        failed = self.db.write(
+            lambda s: s.query(LabImage)
+            .filter(LabImage.status == ImageStatus.BUILDING, LabImage.ts_created < cutoff)
+            .update(
+                {LabImage.status: ImageStatus.FAILED, LabImage.error: "Build interrupted"},
+                synchronize_session=False,
+            )
+        )
+        if failed:
+            logger.warn(f"Marked {failed} interrupted image builds failed")
+
+    def current(self, region=None):
+        # Snapshots are referred to by their numeric id when creating droplets
+        image = self._current.get(region or self.region)
+        return int(image[1]) if image else None
+
+    def version(self, region=None):
+        image = self._current.get(region or self.region)
+        return image[0] if image else None
+
+    def snapshots(self):
+        """ {region: snapshot id} of every region with an image, for create_instance """
+        return {region: int(image[1]) for region, image in self._current.items()}
+
+    def build(self, status_callback=None, region=None):
+        """
+        Provision a reference droplet in region from the stock image, wait
+        for the lab to answer, snapshot it and make the snapshot current
+        """
+
+        region = region or self.region
+
+        if status_callback is not None:
+            next(status_callback)
+
+        if not self._build_lock.acquire(blocking=False):
+            if status_callback is not None:
+                status_callback.send("An image build is already running")
+                status_callback.close()
+            return None
+
+        reference = None
+        try:
+            with self.db.session() as s:
+                version = 1 + max(
+                    (v for v, in s.query(LabImage.version).filter(LabImage.region == region)),
+                    default=0,
+                )
+            image = LabImage(version=version, region=region, status=ImageStatus.BUILDING)
+            self.db.write(lambda s: s.add(image))
+
+            try:
+                if status_callback is not None:
+                    status_callback.send(f"Building image v{version} in {region}")
+                user_data = None
+                if IMAGE_USER_DATA is not None:
+                    with open(IMAGE_USER_DATA) as f:
+                        user_data = f.read()
+                reference, ip = create_instance(
+                    f"image-{version}", tags=[IMAGE_TAG], user_data=user_data, region=region
+                )
+
+                if status_callback is not None:
+                    status_callback.send(f"Reference instance up on {ip}, waiting for the lab")
+                _url = f"http://{ip}:8443"
+                if HealthProber().probe([_url], IMAGE_HEALTH_TIMEOUT).result() is None:
+                    raise Exception(f"Health check failed on {ip}")
+
+                if status_callback is not None:
+                    status_callback.send("Lab healthy, taking snapshot")
+                image.snapshot_id = snapshot_instance(reference, f"labbot-{region}-v{version}")
+                image.status = ImageStatus.READY
+                self.db.write(lambda s: s.merge(image))
+                self._current = dict(self._current, **{region: (version, image.snapshot_id)})
+                logger.info(f"Lab image v{version} ready in {region} as {image.snapshot_id}")
+
+                self.prune(region)
+                if status_callback is not None:
+                    status_callback.send(f"Image v{version} ready, new labs will use {image.snapshot_id}")
+                return image.snapshot_id
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Lab image build failed {e}")
+                image.status = ImageStatus.FAILED
+                image.error = f"{e}"[:255]
+                self.db.write(lambda s: s.merge(image))
+                if status_callback is not None:
+                    status_callback.send(f"Image build failed - {e}")
+                return None
+        finally:
+            if reference is not None:
+                try:
+                    destroy_instance(reference)
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+            self._build_lock.release()
+            if status_callback is not None:
+                status_callback.close()
+
+    def prune(self, region=None):
+        """
+        Retire all but the IMAGE_KEEP newest ready images of region, or of
+        every region. lab_images decides, not this replica's current
+        images, and an image goes only once the next newer one has been
+        ready for IMAGE_PRUNE_GRACE.
+        """
+        cutoff = datetime.now() - timedelta(seconds=IMAGE_PRUNE_GRACE)
+        # The current image always stays
+        keep = max(IMAGE_KEEP, 1)
+        with self.db.session() as s:
+            ready = dict()
+            for image in (
+                s.query(LabImage)
+                .filter(LabImage.status == ImageStatus.READY)
+                .order_by(LabImage.version.desc())
+            ):
+                if region is None or image.region == region:
+                    ready.setdefault(image.region, []).append(image)
+        for images in ready.values():
+            for newer, image in zip(images[keep - 1:], images[keep:]):
+                if (newer.ts_updated or newer.ts_created) > cutoff:
+                    continue
+                self._retire(image)
+
+    def _retire(self, image):
+        # Claim the row first, so replicas pruning together destroy it once
+        claimed = self.db.write(
+            lambda s: s.query(LabImage)
+            .filter(LabImage.id == image.id, LabImage.status == ImageStatus.READY)
+            .update({LabImage.status: ImageStatus.RETIRED}, synchronize_session=False)
+        )
+        if not claimed:
+            return
+        try:
+            destroy_image(image.snapshot_id)
+            logger.info(f"Retired lab image v{image.version} in {image.region}")
+        except Exception as e:
+            logger.error(f"Unable to retire lab image v{image.version} {e}")
+            self.db.write(
+                lambda s: s.query(LabImage)
+                .filter(LabImage.id == image.id)
+                .update({LabImage.status: ImageStatus.READY}, synchronize_session=False)
+            )
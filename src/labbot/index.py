@@ -0,0 +1,79 @@
+"""
+*LabBot* - In memory lab lookup indexes
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+"""
+
+from labbot.database import LabStatus
+
+__all__ = ["LabIndex"]
+
+
+class LabIndex(object):
+    """
+    Secondary indexes over the LabManager lab list, by slack owner and by
+    status, so lookups never need to touch the ORM.
+
+    Not thread safe on its own, callers hold LabManager.list_lock.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+        self._by_owner = dict()
+        self._by_status = dict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def update(self, key, owner, status):
+        self.remove(key)
+        self._entries[key] = (owner, status)
+        if owner is not None:
+            self._by_owner.setdefault(owner, set()).add(key)
+        self._by_status.setdefault(status, set()).add(key)
+
+    def remove(self, key):
+        if key not in self._entries:
+            return
+        owner, status = self._entries.pop(key)
+        if owner is not None:
+            self._by_owner[owner].discard(key)
+            if not self._by_owner[owner]:
+                del self._by_owner[owner]
+        self._by_status[status].discard(key)
+
+    def owner(self, key):
+        return self._entries[key][0]
+
+    def status(self, key):
+        return self._entries[key][1]
+
+    def by_owner(self, owner):
+        return set(self._by_owner.get(owner, ()))
+
+    def by_status(self, *statuses):
+        keys = set()
+        for status in statuses:
+            keys |= self._by_status.get(status, set())
+        return keys
+
+    def count(self, *statuses):
+        return sum(len(self._by_status.get(status, ())) for status in statuses)
+
+    def live(self, owner):
+        """ Key of the owner's lab that is not yet terminated, or None """
+        for key in self._by_owner.get(owner, ()):
+            if self._entries[key][1] is not LabStatus.TERMINATED:
+                return key
+        return None
+
+    def owners(self, *statuses):
+        return {
+            self._entries[key][0]
+            for key in self.by_status(*statuses)
+            if self._entries[key][0] is not None
+        }
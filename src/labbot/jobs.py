@@ -0,0 +1,275 @@
+# flake8: noqa E501
+"""
+*LabBot* - Persistent lab job queue
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Lab operations are queued in the database and run by a pool of worker
+threads, so Slack handlers only have to submit a job. A job is leased by
+the replica running it, jobs whose replica went away are swept up by
+the others.
+
+"""
+
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+import traceback
+from datetime import datetime
+from sqlalchemy import or_
+from labbot.database import LabJob, JobKind, JobStatus
+from labbot.lease import LeaseKeeper, REPLICA_ID
+from labbot.errors import LabExists, LabCloudTimeout, LabQueued, LabNotReady
+from labbot import metrics
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get("LAB_JOB_WORKERS", 4))
+
+
+class JobQueue(object):
+    """
+    Runs LabJob rows against a LabManager
+
+    callback_factory(slack_id) must return a fresh status callback
+    generator, used to report progress to whoever asked for the job.
+    """
+
+    def __init__(self, manager, callback_factory, workers=JOB_WORKERS):
+        self.manager = manager
+        self.db = manager.db
+        self.callback_factory = callback_factory
+        self.workers = workers
+        self._queue = queue.Queue()
+        self.leases = LeaseKeeper(self.db, LabJob, LabJob.id)
+        # Job ids in _queue, so a sweep never queues one twice
+        self._pending = set()
+        self._owner_locks = dict()
+        self._owner_locks_lock = threading.Lock()
+        # Create jobs waiting in the manager's admission queue, by owner
+        self._parked = dict()
+        self._threads = []
+        metrics.gauge(
+            "labbot_jobs_queued", "Lab jobs waiting for a worker", (), lambda: {(): self.depth()}
+        )
+
+    def start(self):
+        if self._threads:
+            return
+
+        # Anything left RUNNING was cut short by a restart, resume it from
+        # its last committed lab stage
+        self.sweep(restart=True)
+
+        for i in range(self.workers):
+            t = threading.Thread(
+                target=self._worker, name=f"labbot-job-{i}", daemon=True
+            )
+            t.start()
+            self._threads.append(t)
+        threading.Thread(target=self._sweeper, name="labbot-job-sweeper", daemon=True).start()
+        logger.info(f"Job queue started with {self.workers} workers")
+
+    def _put(self, job_id, resume):
+        with self._owner_locks_lock:
+            if job_id in self._pending:
+                return
+            self._pending.add(job_id)
+        self._queue.put((job_id, resume))
+
+    def submit(self, kind, slack_id=None):
+        """ Persist a job and queue it, returns the job id """
+        job = LabJob(kind=kind, slack_id=slack_id, status=JobStatus.QUEUED, **self.leases.fields())
+        self.db.write(lambda s: s.add(job))
+        job_id = job.id
+        self.leases.track(job_id)
+        self._put(job_id, False)
+        return job_id
+
+    def sweep(self, restart=False):
+        """
+        Queue unfinished jobs no live replica holds. On restart this
+        replica's own leases are taken back too, see LABBOT_REPLICA_ID.
+        """
+        now = datetime.now()
+        orphaned = [LabJob.lease_owner.is_(None), LabJob.lease_expires < now]
+        if restart:
+            orphaned.append(LabJob.lease_owner == REPLICA_ID)
+        with self.db.session() as s:
+            _jobs = (
+                s.query(LabJob)
+                .filter(
+                    LabJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING]),
+                    or_(*orphaned),
+                )
+                .order_by(LabJob.id)
+                .all()
+            )
+        for job in _jobs:
+            if self.leases.holds(job.id):
+                continue
+            logger.info(f"Requeueing {job}")
+            self._put(job.id, job.status is JobStatus.RUNNING)
+
+    def _sweeper(self):
+        while True:
+            time.sleep(self.leases.ttl)
+            try:
+                self.sweep()
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Job sweep failed {e}")
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _owner_lock(self, slack_id):
+        with self._owner_locks_lock:
+            return self._owner_locks.setdefault(slack_id, threading.Lock())
+
+    def _notify(self, slack_id, message):
+        callback = self.callback_factory(slack_id)
+        next(callback)
+        callback.send(message)
+        callback.close()
+
+    def _unpark(self, slack_id):
+        """ Fail slack_id's parked create job, they have left the line """
+        with self._owner_locks_lock:
+            job_id = self._parked.pop(slack_id, None)
+        if job_id is None:
+            return
+
+        def cancelled(s):
+            job = s.query(LabJob).get(job_id)
+            if job.status is JobStatus.QUEUED:
+                job.status = JobStatus.FAILED
+                job.error = "Left the line for a lab"
+            job.lease_owner = job.lease_expires = None
+
+        self.leases.forget(job_id)
+        self.db.write(cancelled)
+
+    def _unpark_all(self):
+        """ Fail every parked create job, on any replica, ahead of a destroy all """
+        with self._owner_locks_lock:
+            parked = list(self._parked.values())
+            self._parked.clear()
+
+        def cancelled(s):
+            jobs = s.query(LabJob).filter(
+                LabJob.kind == JobKind.CREATE,
+                LabJob.status == JobStatus.QUEUED,
+                # Run once and parked, not yet started jobs are left be
+                LabJob.attempts > 0,
+            )
+            owners = [j.slack_id for j in jobs]
+            jobs.update(
+                {
+                    LabJob.status: JobStatus.FAILED,
+                    LabJob.error: "Line cleared for a reset of all labs",
+                    LabJob.lease_owner: None,
+                    LabJob.lease_expires: None,
+                },
+                synchronize_session=False,
+            )
+            return owners
+
+        for job_id in parked:
+            self.leases.forget(job_id)
+        for slack_id in self.db.write(cancelled):
+            self._notify(slack_id, "All labs are being reset, you have been taken out of the line for a lab")
+
+    def _worker(self):
+        # Jobs picked up at start up would fail while the lab list loads,
+        # leave them QUEUED until it has
+        self.manager.ready.wait()
+        while True:
+            job_id, resume = self._queue.get()
+            with self._owner_locks_lock:
+                self._pending.discard(job_id)
+            try:
+                self._run(job_id, resume)
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Job {job_id} worker error {e}")
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id, resume):
+        # Submitted or parked here the lease is already held
+        if not self.leases.holds(job_id) and not self.leases.acquire(job_id):
+            logger.debug(f"Job {job_id} is held by another replica")
+            return
+
+        def running(s):
+            job = s.query(LabJob).get(job_id)
+            if job.status not in (JobStatus.QUEUED, JobStatus.RUNNING):
+                return None
+            job.status = JobStatus.RUNNING
+            job.attempts += 1
+            return job.kind, job.slack_id
+
+        claimed = self.db.write(running)
+        if claimed is None:
+            self.leases.release(job_id)
+            return
+        kind, slack_id = claimed
+
+        logger.debug(f"Running job {job_id} {kind} for {slack_id} (resume {resume})")
+
+        status, error = JobStatus.DONE, None
+        # One job at a time per owner, so a killlab waits for its makelab
+        with self._owner_lock(slack_id):
+            try:
+                callback = self.callback_factory(slack_id)
+                if kind is JobKind.CREATE:
+                    with self._owner_locks_lock:
+                        self._parked.pop(slack_id, None)
+                    ok = self.manager.create_lab(
+                        slack_id,
+                        callback,
+                        resume=resume,
+                        on_admit=lambda: self._put(job_id, False),
+                    )
+                elif kind is JobKind.RESET:
+                    ok = self.manager.reset_lab(slack_id, callback, resume=resume)
+                elif kind is JobKind.DESTROY:
+                    ok = self.manager.destroy_lab(slack_id, callback)
+                    self._unpark(slack_id)
+                else:
+                    self._unpark_all()
+                    done, failed = self.manager.destroy_all(callback)
+                    ok = not failed
+                if not ok:
+                    status, error = JobStatus.FAILED, "Lab left in UNKNOWN state"
+            except LabQueued as e:
+                # Parked without holding a worker, rerun when admitted
+                status = JobStatus.QUEUED
+                with self._owner_locks_lock:
+                    self._parked[slack_id] = job_id
+                self._notify(slack_id, f"{e}")
+            except (LabExists, LabCloudTimeout, LabNotReady) as e:
+                status, error = JobStatus.FAILED, f"{e}"
+                self._notify(slack_id, f"{e}")
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                status, error = JobStatus.FAILED, f"{e}"
+                self._notify(slack_id, f"Unhandled Exception {e}")
+
+        # A parked job keeps its lease until it is admitted
+        done = status is not JobStatus.QUEUED
+        if done:
+            self.leases.forget(job_id)
+
+        def finished(s):
+            job = s.query(LabJob).get(job_id)
+            job.status = status
+            job.error = error[:255] if error else None
+            if done:
+                job.lease_owner = job.lease_expires = None
+
+        self.db.write(finished)
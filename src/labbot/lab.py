@@ -12,78 +12,596 @@ import threading
 import time
 import sys
 import traceback
-from urllib.request import urlopen
-from labbot.database import DB, Lab, LabStatus
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from labbot.database import DB, Lab, LabArchive, LabLock, LabStatus
 from labbot.singleton import Singleton
-from labbot.errors import LabExists, LabTotalExceeded
-from labbot.cloud.do import create_instance, destroy_instance
+from labbot.errors import LabExists, LabQueued, LabCloudException, LabNotReady
+from labbot.cloud.do import create_instance, create_instances, destroy_instance, rebuild_instance, wait_rebuild
 from labbot.cloud.cloudflare import create_lab_a_record, delete_lab_a_record
+from labbot.pool import LabPool, POOL_STATUSES
+from labbot.index import LabIndex
+from labbot.fleet import FleetSnapshot, LabView
+from labbot.admission import AdmissionQueue
+from labbot.phonehome import PhoneHome
+from labbot.expiry import ExpiryScheduler
+from labbot.reconciler import Reconciler
+from labbot.images import ImageManager
+from labbot.lease import LeaseKeeper, REPLICA_ID
+from labbot import metrics
 from datetime import timedelta, datetime
 
 logger = logging.getLogger(__name__)
 
-LAB_INSTANCES_MAX = os.environ.get("LAB_INSTANCE_MAX", 4)
+LAB_INSTANCES_MAX = int(os.environ.get("LAB_INSTANCE_MAX", 4))
+LAB_DESTROY_WORKERS = int(os.environ.get("LAB_DESTROY_WORKERS", 8))
+LAB_CREATE_WORKERS = int(os.environ.get("LAB_CREATE_WORKERS", 16))
+# How long a command waits for the lab list to load after a restart
+LAB_READY_TIMEOUT = float(os.environ.get("LAB_READY_TIMEOUT", 60))
+LAB_HYDRATE_RETRY = float(os.environ.get("LAB_HYDRATE_RETRY", 5))
+# How often each replica picks up lab changes made by the others
+LAB_SYNC_INTERVAL = float(os.environ.get("LAB_SYNC_INTERVAL", 5))
+
+# Rows of lab_locks, reservations serialise on one, the other elects
+# the replica that runs expiry, the reconciler and the pool
+QUOTA_LOCK = "quota"
+LEADER_LOCK = "leader"
+
+CREATE_STATUSES = (
+    LabStatus.WAITING_INSTANCE,
+    LabStatus.WAITING_DNS,
+    LabStatus.WAITING_HEALTH,
+)
+
+# A lab's lease is given up once its pipeline reaches one of these
+REST_STATUSES = (LabStatus.ACTIVE, LabStatus.POOL_READY, LabStatus.UNKNOWN)
+# Owned by the lease, never written back from a working copy
+UNSAVED_COLUMNS = ("id", "lease_owner", "lease_expires")
 
 
 class LabManager(object, metaclass=Singleton):
-    def __init__(self, db, default_max_labs, default_lab_lifetime):
+    """
+    Lab lifecycle for one bot replica, any number can share the database
+
+    The DB is the authority, reservations count slots and claim owners in
+    one transaction and a lab's pipeline holds its lease while it runs.
+    Each replica keeps the live labs in memory and syncs the others'
+    changes every LAB_SYNC_INTERVAL seconds.
+    """
+
+    def __init__(
+        self,
+        db,
+        default_max_labs,
+        default_lab_lifetime,
+        pool_size=0,
+        callback_factory=None,
+        hedge=False,
+    ):
         self.db = db
         self.max_labs = default_max_labs
         self.lab_lifetime = default_lab_lifetime
+        # Race a second droplet against slow creates, see create_instance
+        self.hedge = hedge
+        self.callback_factory = callback_factory
         self.list_lock = threading.Lock()
         self._labs = dict()
+        self._entered = dict()
+        self._touched = dict()
+        self.index = LabIndex()
+        self.fleet = FleetSnapshot()
+        self.leases = LeaseKeeper(db, Lab, Lab.id)
+        self.locks = LeaseKeeper(db, LabLock, LabLock.name)
+        self.admissions = AdmissionQueue()
+        self.images = ImageManager(db)
+        self.expiry = ExpiryScheduler(self, callback_factory)
+        self.pool = LabPool(self, pool_size)
+        self.reconciler = Reconciler(self)
+        self.ready = threading.Event()
+        metrics.gauge("labbot_labs", "Live labs by status", ("status",), self._status_counts)
+        metrics.gauge("labbot_lab_queue", "Owners waiting for a lab slot", (), self._queue_depth)
+        # Load the lab list off the start up path, commands wait on ready
+        threading.Thread(target=self._hydrate, name="labbot-hydrate", daemon=True).start()
+
+    def _hydrate(self):
+        """ Load live labs and the current image, then start the background workers """
+        while True:
+            try:
+                self._load()
+                break
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Loading labs failed {e}, retrying")
+                time.sleep(LAB_HYDRATE_RETRY)
+        self.ready.set()
+
+        self._lead()
+        self.pool.start()
+        self.expiry.start()
+        self.reconciler.start()
+        threading.Thread(target=self._sync_loop, name="labbot-sync", daemon=True).start()
+
+    def _load(self):
+        _start = time.time()
+        self._ensure_locks()
+        # Only live labs are kept in memory, terminated ones are archived
+        with self.db.session() as s:
+            _labs = s.query(Lab).filter(Lab.status != LabStatus.TERMINATED).all()
+        with self.list_lock:
+            for _lab in _labs:
+                self._index(_lab)
+        for _lab in _labs:
+            if _lab.status is LabStatus.ACTIVE:
+                self.expiry.schedule(
+                    str(_lab.id), _lab.slack_owner_id, self._expires(_lab)
+                )
+        self.images.load()
+        logger.info(f"Loaded {len(_labs)} labs in {time.time() - _start:.2f}s")
+
+    def wait_ready(self, timeout=LAB_READY_TIMEOUT):
+        """ Block until the lab list has loaded, raise LabNotReady after timeout """
+        if not self.ready.wait(timeout):
+            raise LabNotReady("LabBot is still starting up, try again in a moment")
+
+    def _ensure_locks(self):
+        def ensure(s):
+            have = {name for name, in s.query(LabLock.name)}
+            for name in (QUOTA_LOCK, LEADER_LOCK):
+                if name not in have:
+                    s.add(LabLock(name=name))
+
+        try:
+            self.db.write(ensure)
+        except IntegrityError:
+            # Another replica starting at the same time made them
+            pass
+
+    def is_leader(self):
+        """ True if this replica runs expiry, the reconciler and the pool """
+        return self.locks.holds(LEADER_LOCK)
+
+    def _lead(self):
+        """ Take over as leader if nobody holds it, True if newly elected """
+        if self.is_leader() or not self.locks.acquire(LEADER_LOCK):
+            return False
+        logger.info(f"Replica {REPLICA_ID} is now the leader")
+        self.pool.wakeup()
+        return True
+
+    def _sync_loop(self):
+        while True:
+            time.sleep(LAB_SYNC_INTERVAL)
+            try:
+                if self._lead():
+                    # Expiries that came due while the old leader was gone
+                    threading.Thread(target=self.expire_labs, name="labbot-expire", daemon=True).start()
+                self._sync()
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Lab sync failed {e}")
+
+    def _sync(self):
+        """
+        Pick up labs other replicas created, changed or archived, and the
+        images they built. Labs leased here, or changed here since the
+        read, are already current.
+        """
+        _start = time.time()
         with self.db.session() as s:
-            _labs_query = s.query(Lab)
-            for _lab in _labs_query:
-                self._labs[str(_lab.id)] = _lab
+            _labs = {str(lab.id): lab for lab in s.query(Lab).filter(Lab.status != LabStatus.TERMINATED)}
+        self.images.refresh()
+
+        def current(key):
+            return self.leases.holds(int(key)) or self._touched.get(key, 0) >= _start
+
+        columns = [c.name for c in Lab.__table__.columns if c.name not in UNSAVED_COLUMNS]
+        changed, gone = [], []
+        with self.list_lock:
+            for key in [k for k in self._labs if k not in _labs and not current(k)]:
+                self._drop(key)
+                gone.append(key)
+            for key, lab in _labs.items():
+                old = self._labs.get(key)
+                if current(key) or (
+                    old is not None
+                    and all(getattr(old, c) == getattr(lab, c) for c in columns)
+                ):
+                    continue
+                self._index(lab, observe=False)
+                changed.append(lab)
+            admitted = self._admit()
+
+        for key in gone:
+            self.expiry.cancel(key)
+        for lab in changed:
+            key = str(lab.id)
+            if lab.status is not LabStatus.ACTIVE:
+                self.expiry.cancel(key)
+            elif self.expiry.expires(key) != self._expires(lab).timestamp():
+                self.expiry.schedule(key, lab.slack_owner_id, self._expires(lab))
+        self._start_admitted(admitted)
+        if changed or gone:
+            logger.debug(f"Synced {len(changed)} changed and {len(gone)} archived labs")
+
+    def _status_counts(self):
+        view = self.fleet.view()
+        return {(status.name,): view.count(status) for status in LabStatus}
+
+    def _queue_depth(self):
+        return {(): len(self.fleet.view().queue)}
+
+    def _expires(self, lab):
+        """ Expiry time of lab, labs from before expiry count from their last update """
+        if lab.ts_expires is not None:
+            return lab.ts_expires
+        return (lab.ts_updated or lab.ts_created) + timedelta(seconds=self.lab_lifetime)
+
+    @staticmethod
+    def _copy(lab):
+        """ Detached copy of lab's columns, safe to change without a session """
+        return Lab(**{c.name: getattr(lab, c.name) for c in Lab.__table__.columns})
+
+    def _checkout(self, key):
+        """ Working copy of lab key for a pipeline to change, must hold list_lock """
+        return self._copy(self._labs[key])
+
+    def _index(self, lab, observe=True):
+        """ Track lab in the lab list and indexes, must hold list_lock """
+        key = str(lab.id)
+        if key in self.index and self.index.status(key) is not lab.status:
+            if observe:
+                self._observe_stage(key)
+            else:
+                # Changed by another replica, which times its own stages
+                self._entered.pop(key, None)
+        self._entered.setdefault(key, time.time())
+        self._touched[key] = time.time()
+        self._labs[key] = self._copy(lab)
+        self.index.update(key, lab.slack_owner_id, lab.status)
+        self.fleet.put(
+            LabView(
+                key,
+                lab.slack_owner_id,
+                lab.status,
+                self._entered[key],
+                lab.url,
+                self._expires(lab) if lab.status is LabStatus.ACTIVE else None,
+            )
+        )
+
+    def _drop(self, key):
+        """ Forget lab key, must hold list_lock """
+        self._labs.pop(key, None)
+        self._entered.pop(key, None)
+        self._touched.pop(key, None)
+        self.index.remove(key)
+        self.fleet.remove(key)
+
+    def _observe_stage(self, key):
+        """ Time spent in the status key is leaving, must hold list_lock """
+        entered = self._entered.pop(key, None)
+        if entered is not None:
+            metrics.STAGE_SECONDS.observe(time.time() - entered, self.index.status(key).name)
+
+    def _save(self, lab):
+        """ Write lab's columns back to its row, in the DB writer's next commit """
+        lab_id = lab.id
+        values = {
+            c.name: getattr(lab, c.name)
+            for c in Lab.__table__.columns
+            if c.name not in UNSAVED_COLUMNS
+        }
+        self.db.write(
+            lambda s: s.query(Lab)
+            .filter(Lab.id == lab_id)
+            .update(values, synchronize_session=False)
+        )
+
+    def _transition(self, lab, status):
+        """ Commit lab moving to status and update the indexes to match """
+        lab.status = status
+        if status is LabStatus.TERMINATED:
+            self._archive(lab)
+            return
+        lab.ts_updated = datetime.now()
+        self._save(lab)
+        with self.list_lock:
+            self._index(lab)
+        if status in REST_STATUSES:
+            self.leases.release(lab.id)
+
+    def _lease(self, key):
+        """
+        Take lab key's lease and return a fresh working copy of it, None
+        if another replica or thread is working on it or it is gone
+        """
+        lab_id = int(key)
+        if not self.leases.acquire(lab_id):
+            return None
+        with self.db.session() as s:
+            lab = s.query(Lab).get(lab_id)
+        if lab is None:
+            self.leases.forget(lab_id)
+            return None
+        with self.list_lock:
+            self._index(lab, observe=False)
+            return self._checkout(key)
+
+    def _archive(self, lab):
+        """ Move a terminated lab out of the labs table and out of memory """
+        key = str(lab.id)
+        archived = LabArchive.from_lab(lab)
+
+        def archive(s):
+            s.add(archived)
+            s.query(Lab).filter(Lab.id == lab.id).delete(synchronize_session=False)
+
+        self.db.write(archive)
+        self.leases.forget(lab.id)
+        self.expiry.cancel(key)
+        with self.list_lock:
+            self._observe_stage(key)
+            self._drop(key)
+            admitted = self._admit()
+        self._start_admitted(admitted)
+
+    def _instance_count(self, s, slack_id):
+        """ Number of labs slack_id has ever had, live and archived """
+        return sum(
+            s.query(func.coalesce(func.sum(m.instances), 0))
+            .filter(m.slack_owner_id == slack_id)
+            .scalar()
+            for m in (Lab, LabArchive)
+        )
+
+    def _check_quota(self, slack_id):
+        """ Raise if slack_id may not have another lab, must hold list_lock """
+        if self.index.live(slack_id) is not None:
+            raise LabExists(
+                f"Slack ID {slack_id} already has an active/stuck lab.  Terminate with command 'killlab'"
+            )
+        if slack_id in self.admissions:
+            raise LabExists(
+                f"Slack ID {slack_id} is already #{self.admissions.position(slack_id)} in line for a lab"
+            )
+
+    def _used(self):
+        """ Lab slots taken by live labs and held admissions, must hold list_lock """
+        return len(self.index) - self.index.count(*POOL_STATUSES) + self.admissions.reserved()
 
-    def create_lab(self, slack_id, status_callback=None):
+    def _admissible(self, slack_id):
+        """ True if slack_id may take a slot now, must hold list_lock """
+        if self.admissions.holds(slack_id):
+            return True
+        # Nobody jumps the line while it is not empty
+        return not self.admissions and self._used() < self.max_labs
 
+    def _admit(self):
+        """ Hold freed slots for the front of the line, must hold list_lock """
+        admitted = self.admissions.admit(self.max_labs - self._used())
+        # Every change to the line is followed by this
+        self.fleet.queue(self.admissions.waiting())
+        return admitted
+
+    def _start_admitted(self, admitted):
+        for slack_id, start in admitted:
+            logger.info(f"Lab slot free for {slack_id}")
+            try:
+                start()
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Starting admitted lab for {slack_id} failed {e}")
+
+    def _eta(self, position):
+        """ Seconds until position gets a slot if no lab ends early, None if unknown, must hold list_lock """
+        deadlines = sorted(
+            d
+            for d in (self.expiry.expires(k) for k in self.index.by_status(LabStatus.ACTIVE))
+            if d is not None
+        )
+        if position > len(deadlines):
+            return None
+        return max(deadlines[position - 1] - time.time(), 0)
+
+    def _enqueue(self, slack_id, on_admit, status_callback=None, front=False):
+        """
+        Put slack_id in line for the next free slot. Without on_admit
+        this blocks until they are admitted, with it on_admit() is called
+        then and LabQueued raised now. Must not hold list_lock.
+        """
+        admitted = threading.Event()
+        with self.list_lock:
+            position = self.admissions.enqueue(slack_id, on_admit or admitted.set, front)
+            eta = self._eta(position)
+            # A hold may have lapsed since the last slot was freed
+            free = self._admit()
+        self._start_admitted(free)
+
+        message = f"All {self.max_labs} labs are in use, you are #{position} in line"
+        if eta is not None:
+            message += f", expected wait about {int(eta / 60) + 1} minutes"
+        message += ". Your lab will start as soon as a slot frees up"
+        logger.info(f"Queued {slack_id} at #{position}")
+        if on_admit is not None:
+            raise LabQueued(message)
         if status_callback is not None:
-            next(status_callback)
+            status_callback.send(message)
+
+        admitted.wait()
+        with self.list_lock:
+            if not self.admissions.holds(slack_id):
+                raise LabExists(f"Slack ID {slack_id} left the line for a lab")
 
-        lab = None
+    def _reserve(self, slack_id, use_pool=True, on_admit=None, status_callback=None):
+        """
+        Quota checks and lab row creation, returns (lab, pooled). Waits
+        in the admission queue while every slot is taken, see _enqueue.
+        """
+
+        # History lives in the DB, check it before taking the lock
         with self.db.session() as s:
+            instances = self._instance_count(s, slack_id)
+        if instances > LAB_INSTANCES_MAX:
+            raise LabExists(
+                f"Slack ID {slack_id} has already had {instances} labs, no more allowed"
+            )
+
+        while True:
             with self.list_lock:
-                if len(self._labs) >= self.max_labs:
-                    raise LabTotalExceeded(
-                        f"Sorry, there are already {self.max_labs} allocated, try again later"
-                    )
-                for k, v in self._labs.items():
-                    v = s.merge(v)
-                    if (
-                        v.slack_owner_id == slack_id
-                        and v.status is not LabStatus.TERMINATED
-                    ):
-                        raise LabExists(
-                            f"Slack ID {slack_id} already has an active/stuck lab.  Terminate with command 'killlab'"
-                        )
-                    if v.slack_owner_id == slack_id and v.instances > LAB_INSTANCES_MAX:
-                        raise LabExists(
-                            f"Slack ID {slack_id} has already had {v.instances} labs, no more allowed"
-                        )
+                self._check_quota(slack_id)
+                admissible = self._admissible(slack_id)
+                held = self.admissions.holds(slack_id)
 
-                lab = Lab(slack_owner_id=slack_id, status=LabStatus.WAITING_INSTANCE)
-                s.add(lab)
-                self._labs[str(lab.id)] = lab
-                s.commit()
+            if not admissible:
+                self._enqueue(slack_id, on_admit, status_callback)
+                continue
 
-            logger.debug(
-                f"Creating new Lab {lab.id} for slack client {lab.slack_owner_id}"
-            )
+            # The DB has the final say, other replicas take slots too
+            exists = False
+            try:
+                lab, pooled = self.db.write(lambda s: self._take_slot(s, slack_id, use_pool))
+            except IntegrityError:
+                lab, exists = None, True
+
+            if lab is not None:
+                self.leases.track(lab.id)
+                with self.list_lock:
+                    self.admissions.take(slack_id)
+                    self._index(lab)
+                    lab = self._checkout(str(lab.id))
+                if pooled:
+                    self.pool.wakeup()
+                return lab, pooled
+
+            with self.list_lock:
+                self.admissions.take(slack_id)
+            if exists:
+                with self.list_lock:
+                    admitted = self._admit()
+                self._start_admitted(admitted)
+                raise LabExists(
+                    f"Slack ID {slack_id} already has an active/stuck lab.  Terminate with command 'killlab'"
+                )
+
+            # Another replica took the last slot, catch up with it and
+            # wait at the front of the line if this one was held for us
+            self._sync()
+            self._enqueue(slack_id, on_admit, status_callback, front=held)
+
+    def _take_slot(self, s, slack_id, use_pool):
+        """
+        Reservation transaction, returns (lab, pooled) with the lab leased
+        here, or (None, False) if every slot is taken. A second live lab
+        for slack_id fails the owner's unique index with IntegrityError.
+        """
+        # Reservations from every replica queue up behind this row lock
+        s.query(LabLock).filter(LabLock.name == QUOTA_LOCK).update(
+            {LabLock.name: LabLock.name}, synchronize_session=False
+        )
+        used = (
+            s.query(func.count(Lab.id))
+            .filter(Lab.slack_owner_id.isnot(None), Lab.status != LabStatus.TERMINATED)
+            .scalar()
+        )
+        if used >= self.max_labs:
+            return None, False
 
-            # Finish with the lock as quick as we can
-            # and now go through the stages to create the lab
+        lease = self.leases.fields()
+        # Take a warm instance if there is one, otherwise cold start
+        lab = self.pool.claim(s, slack_id, lease) if use_pool else None
+        if lab is not None:
+            return lab, True
+
+        lab = Lab(
+            slack_owner_id=slack_id,
+            status=LabStatus.WAITING_INSTANCE,
+            active=True,
+            instances=0,
+            ts_created=datetime.now(),
+            **lease,
+        )
+        s.add(lab)
+        s.flush()
+        return lab, False
+
+    def _resumable(self, slack_id):
+        """
+        The owner's lab if it was left part way through creation, leased
+        for this call. Raises LabExists if another replica is on it.
+        """
+        with self.list_lock:
+            key = self.index.live(slack_id)
+            if key is None or self.index.status(key) not in CREATE_STATUSES:
+                return None
+        lab = self._lease(key)
+        if lab is None:
+            raise LabExists(f"Lab for {slack_id} is busy, try again shortly")
+        if lab.status not in CREATE_STATUSES:
+            self.leases.release(lab.id)
+            return None
+        return lab
+
+    def create_lab(self, slack_id, status_callback=None, resume=False, on_admit=None):
+        """
+        Create a lab for slack_id, returns it or None on failure. When
+        every slot is taken this waits its turn in line, or with on_admit
+        raises LabQueued and calls on_admit() once a slot is held for them.
+        """
+
+        self.wait_ready()
+        if status_callback is not None:
+            next(status_callback)
+
+        _start = time.time()
+        pooled = False
+        try:
+            # Pick up from the last committed stage when resuming a job
+            lab = self._resumable(slack_id) if resume else None
+            if lab is None:
+                lab, pooled = self._reserve(slack_id, on_admit=on_admit, status_callback=status_callback)
+        except (LabExists, LabQueued):
             if status_callback is not None:
-                status_callback.send("Starting Instance Creation")
+                status_callback.close()
+            raise
 
-            try:
-                _instance_id, _ip = create_instance(lab.slack_owner_id)
+        return self._build(lab, pooled, status_callback, _start)
+
+    def _build(self, lab, pooled, status_callback, _start, token=None):
+        """
+        Take a leased lab through the remaining creation stages, returns
+        it or None on failure. status_callback must already be started,
+        token is the PhoneHome token its droplet was created with.
+        """
+
+        logger.debug(
+            f"Creating Lab {lab.id} for slack client {lab.slack_owner_id} from {lab.status} (pooled {pooled})"
+        )
+
+        # Finish with the lock as quick as we can
+        # and now go through the stages to create the lab
+        try:
+            if pooled:
+                if status_callback is not None:
+                    status_callback.send("Using pre-built Instance")
+                self.pool.release(lab)
+
+            if lab.status is LabStatus.WAITING_INSTANCE:
+                if status_callback is not None:
+                    status_callback.send("Starting Instance Creation")
+
+                token = PhoneHome().expect()
+                _instance_id, _ip = create_instance(
+                    lab.slack_owner_id,
+                    image=self.images.snapshots(),
+                    phone_home=token,
+                    hedge=self.hedge,
+                )
                 lab.do_reference = _instance_id
                 lab.ip = _ip
-                lab.status = LabStatus.WAITING_DNS
-                s.commit()
+                self._transition(lab, LabStatus.WAITING_DNS)
 
+            if lab.status is LabStatus.WAITING_DNS:
                 # Setup DNS record
                 if status_callback is not None:
                     status_callback.send("Instance Ready - Setting up DNS")
@@ -91,139 +609,442 @@ class LabManager(object, metaclass=Singleton):
                 dns_reference, dns_url = create_lab_a_record(lab.slack_owner_id, lab.ip)
                 lab.cf_reference = dns_reference
                 lab.url = f"http://{dns_url}:8443"
-                lab.status = LabStatus.WAITING_HEALTH
-                s.commit()
+                self._transition(lab, LabStatus.WAITING_HEALTH)
+
+            if lab.do_action is not None:
+                # A reset, the old image would still answer until rebuilt
+                wait_rebuild(lab.do_reference, lab.do_action)
+                lab.do_action = None
 
-                # Validate URL
+            # Validate URL, pooled instances were already checked on their IP
+            if not pooled:
                 if status_callback is not None:
                     status_callback.send(f"Doing Health Check on {lab.url}")
-                time.sleep(10)
-                try:
-                    wait_until = datetime.now() + timedelta(minutes=1)
-                    break_loop = False
-                    while not break_loop:
-                        code = urlopen(lab.url).getcode()
-                        if wait_until < datetime.now() or int(code / 200) == 2:
-                            break_loop = True
-                except Exception:
-                    pass
-
-                if break_loop:
-                    status_callback.send(
-                        "Could not do health check, DNS may have failed, use IP, and hope for the best"
-                    )
+                _ip_url = f"http://{lab.ip}:8443"
+                # Ready as soon as the droplet phones home, probing is the fallback
+                healthy_url = PhoneHome().ready(token, [lab.url, _ip_url]).result()
 
-                # No, don't do this.  But need to, can't remember
-                # urllib exception for dns fail, but in final hour
-                # need to move on
+                # Carry on regardless, the lab may still come good
+                if status_callback is not None:
+                    if healthy_url is None:
+                        status_callback.send(
+                            "Could not do health check, DNS may have failed, use IP, and hope for the best"
+                        )
+                    elif healthy_url == _ip_url:
+                        status_callback.send(
+                            "Health check passed on IP only, DNS may still be propagating"
+                        )
 
-                lab.status = LabStatus.ACTIVE
+            # A reset lab was up before, it keeps its count and expiry
+            reset = lab.ts_expires is not None
+            if not reset:
                 lab.instances += 1
-                s.commit()
+                lab.ts_expires = datetime.now() + timedelta(seconds=self.lab_lifetime)
+            self._transition(lab, LabStatus.ACTIVE)
+            self.expiry.schedule(str(lab.id), lab.slack_owner_id, lab.ts_expires)
+            if not reset:
+                metrics.READY_SECONDS.observe(time.time() - _start, str(pooled).lower())
 
-                if status_callback is not None:
-                    status_callback.send(f"Instance Ready to use at {lab.url}")
-                    status_callback.send(f"Instance Ready to use http://{lab.ip}:8443")
-                    status_callback.close()
+            if status_callback is not None:
+                status_callback.send(f"Instance Ready to use at {lab.url}")
+                status_callback.send(f"Instance Ready to use http://{lab.ip}:8443")
+                status_callback.close()
 
-                return lab
-            except Exception as e:
-                traceback.print_exc(file=sys.stdout)
-                logger.error(f"Instance Creation Error {e}")
-                lab.status = LabStatus.UNKNOWN
-                s.commit()
-                if status_callback is not None:
-                    status_callback.send(f"Instance Failed - {e}")
-                    status_callback.close()
+            return lab
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Instance Creation Error {e}")
+            PhoneHome().forget(token)
+            self._transition(lab, LabStatus.UNKNOWN)
+            if status_callback is not None:
+                status_callback.send(f"Instance Failed - {e}")
+                status_callback.close()
 
-    def destroy_lab(self, slack_id, status_callback=None):
+    def create_labs(self, slack_ids, status_callback=None, callback_factory=None):
+        """
+        Provision labs for a whole class, droplets are created in batches
+        and each lab then goes through DNS and health on its own, owners
+        hear about it from callback_factory. Returns (done, failed), owners
+        past capacity are queued and in neither.
+        """
 
+        self.wait_ready()
         if status_callback is not None:
             next(status_callback)
+            status_callback.send(f"Provisioning {len(slack_ids)} labs")
 
-        lab = None
-        with self.db.session() as s:
-            with self.list_lock:
-                for k, v in self._labs.items():
-                    v = s.merge(v)
-                    if v.slack_owner_id == slack_id:
-                        lab = v
+        def report(message):
+            if status_callback is not None:
+                status_callback.send(f"{message} ({len(done) + len(failed)}/{len(slack_ids)})")
 
-            # Finish with the lock as quick as we can
-            # and now go through the stages to delete the lab
-            if lab is None:
-                raise LabExists(
-                    f"Slack ID {slack_id} does not have a lab associated with it"
-                )
+        def start(slack_id):
+            # Over capacity the rest of the class queues like everyone else
+            return lambda: threading.Thread(
+                target=self.create_lab,
+                args=(slack_id, callback_factory(slack_id) if callback_factory else None),
+                name="labbot-admitted",
+                daemon=True,
+            ).start()
+
+        done, failed, queued = [], [], []
+        keys = dict()
+        for slack_id in slack_ids:
+            try:
+                # Pool labs are left for walk ins, a class gets fresh ones
+                lab, _ = self._reserve(slack_id, use_pool=False, on_admit=start(slack_id))
+                keys[slack_id] = str(lab.id)
+            except LabQueued:
+                queued.append(slack_id)
+            except LabExists as e:
+                failed.append(slack_id)
+                report(f"Skipped {slack_id} - {e}")
+        if queued:
+            report(f"All {self.max_labs} labs in use, {len(queued)} queued for a free slot")
+
+        tokens = {slack_id: PhoneHome().expect() for slack_id in keys}
+        try:
+            instances = create_instances(
+                list(keys), image=self.images.snapshots(), phone_home=tokens
+            )
+        except Exception as e:
+            instances = dict()
+            for slack_id in keys:
+                instances[slack_id] = Future()
+                instances[slack_id].set_exception(e)
 
-            lab = s.merge(lab)
+        with ThreadPoolExecutor(
+            max_workers=LAB_CREATE_WORKERS, thread_name_prefix="labbot-create"
+        ) as executor:
+            # Each lab carries on as soon as its own droplet is ready
+            owners = {instances[slack_id]: slack_id for slack_id in keys}
+            labs = dict()
+            for instance in as_completed(owners):
+                slack_id = owners[instance]
+                labs[
+                    executor.submit(
+                        self._create_from_instance,
+                        slack_id,
+                        keys[slack_id],
+                        instance,
+                        callback_factory(slack_id) if callback_factory else None,
+                        tokens[slack_id],
+                    )
+                ] = slack_id
+
+            for future in as_completed(labs):
+                slack_id = labs[future]
+                try:
+                    if future.result() is None:
+                        raise LabCloudException("creation failed, lab left UNKNOWN")
+                    done.append(slack_id)
+                    report(f"Lab ready for {slack_id}")
+                except Exception as e:
+                    failed.append(slack_id)
+                    logger.error(f"Lab creation for {slack_id} failed {e}")
+                    report(f"Failed lab creation for {slack_id} - {e}")
 
-            logger.debug(
-                f"Destroying Lab {lab.id} for slack client {lab.slack_owner_id}"
+        if status_callback is not None:
+            status_callback.send(
+                f"Done... {len(done)} labs ready, {len(failed)} failed"
+                + (f" ({', '.join(failed)})" if failed else "")
+                + (f", {len(queued)} queued" if queued else "")
             )
-            lab.status = LabStatus.DEACTIVATE_INSTANCE
-            s.commit()
+            status_callback.close()
+
+        return done, failed
 
+    def _create_from_instance(self, slack_id, key, instance, status_callback=None, token=None):
+        """ Record the droplet from a batch create and finish creating the lab """
+
+        _start = time.time()
+        if status_callback is not None:
+            next(status_callback)
+        with self.list_lock:
+            lab = self._checkout(key)
+        try:
+            lab.do_reference, lab.ip = instance.result()
+        except Exception as e:
+            logger.error(f"Instance Creation Error {e}")
+            PhoneHome().forget(token)
+            self._transition(lab, LabStatus.UNKNOWN)
             if status_callback is not None:
-                status_callback.send("Starting instance termination")
+                status_callback.send(f"Instance Failed - {e}")
+                status_callback.close()
+            return None
+        self._transition(lab, LabStatus.WAITING_DNS)
 
-            try:
-                destroy_instance(lab.do_reference)
+        # Still leased from _reserve
+        return self._build(lab, False, status_callback, _start, token)
+
+    def destroy_lab(self, slack_id, status_callback=None):
+
+        self.wait_ready()
+        if status_callback is not None:
+            next(status_callback)
+
+        admitted = None
+        with self.list_lock:
+            key = self.index.live(slack_id)
+            if key is None and self.admissions.cancel(slack_id):
+                # Still in line, or admitted and not started, give the slot on
+                admitted = self._admit()
+
+        # Finish with the lock as quick as we can
+        # and now go through the stages to delete the lab
+        if admitted is not None:
+            self._start_admitted(admitted)
+            if status_callback is not None:
+                status_callback.send("Removed you from the line for a lab")
+                status_callback.close()
+            return True
+
+        if key is None:
+            raise LabExists(
+                f"Slack ID {slack_id} does not have a lab associated with it"
+            )
+
+        lab = self._lease(key)
+        if lab is None:
+            raise LabExists(f"Lab for {slack_id} is busy, try again shortly")
+        return self._teardown(lab, status_callback)
+
+    def _teardown(self, lab, status_callback=None):
+        """ Run a leased lab through the remaining teardown stages, returns None on failure """
+
+        logger.debug(
+            f"Destroying Lab {lab.id} for slack client {lab.slack_owner_id} from {lab.status}"
+        )
+
+        try:
+            # A resumed teardown may already be past the instance stage
+            if lab.status is not LabStatus.DEACTIVATE_DNS:
+                self._transition(lab, LabStatus.DEACTIVATE_INSTANCE)
+
+                if status_callback is not None:
+                    status_callback.send("Starting instance termination")
+
+                if lab.do_reference is not None:
+                    destroy_instance(lab.do_reference)
                 lab.do_reference = None
                 lab.ip = None
-                lab.status = LabStatus.DEACTIVATE_DNS
-                s.commit()
+                self._transition(lab, LabStatus.DEACTIVATE_DNS)
 
-                # Clean up DNS record
-                if status_callback is not None:
-                    status_callback.send("Instance Terminating - Cleaning up DNS")
+            # Clean up DNS record
+            if status_callback is not None:
+                status_callback.send("Instance Terminating - Cleaning up DNS")
 
+            if lab.cf_reference is not None:
                 delete_lab_a_record(lab.cf_reference)
-                lab.cf_reference = None
-                lab.url = None
-                lab.status = LabStatus.TERMINATED
-                s.commit()
+            lab.cf_reference = None
+            lab.url = None
+            self._transition(lab, LabStatus.TERMINATED)
 
-                if status_callback is not None:
-                    status_callback.send(
-                        f"Instance has been terminated.  Thanks for playing !"
-                    )
-                    status_callback.close()
+            if status_callback is not None:
+                status_callback.send(
+                    f"Instance has been terminated.  Thanks for playing !"
+                )
+                status_callback.close()
 
-                return lab
-            except Exception as e:
-                traceback.print_exc(file=sys.stdout)
-                logger.error(f"Instance Termination Error {e}")
-                lab.status = LabStatus.UNKNOWN
-                s.commit()
-                if status_callback is not None:
-                    status_callback.send(f"Instance Termination Failed - {e}")
-                    status_callback.close()
+            return lab
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Instance Termination Error {e}")
+            self._transition(lab, LabStatus.UNKNOWN)
+            if status_callback is not None:
+                status_callback.send(f"Instance Termination Failed - {e}")
+                status_callback.close()
 
-    def destroy_all(self, status_callback=None):
+    def reset_lab(self, slack_id, status_callback=None, resume=False):
+        """
+        Reimage slack_id's active lab on its droplet, keeping its IP, DNS
+        record, expiry and instance count. Returns the lab or None on
+        failure. resume finishes a reset cut short by a restart.
+        """
 
-        owners = []
+        self.wait_ready()
+        if status_callback is not None:
+            next(status_callback)
 
-        with self.db.session() as s:
+        _start = time.time()
+        try:
             with self.list_lock:
-                for k, v in self._labs.items():
-                    v = s.merge(v)
-                    owners.append(v.slack_owner_id)
+                key = self.index.live(slack_id)
+            if key is None:
+                raise LabExists(
+                    f"Slack ID {slack_id} does not have a lab associated with it"
+                )
+            lab = self._lease(key)
+            if lab is None:
+                raise LabExists(f"Lab for {slack_id} is busy, try again shortly")
+            if resume and lab.status is LabStatus.WAITING_HEALTH:
+                return self._build(lab, False, status_callback, _start)
+            if lab.status is not LabStatus.ACTIVE:
+                self.leases.release(lab.id)
+                raise LabExists(
+                    f"Lab for {slack_id} is {lab.status.name}, only an active lab can be reset"
+                )
+        except LabExists:
+            if status_callback is not None:
+                status_callback.close()
+            raise
+
+        logger.debug(f"Resetting Lab {lab.id} for slack client {slack_id}")
+
+        try:
+            if status_callback is not None:
+                status_callback.send("Reimaging instance, your lab address stays the same")
+            # Back through the health stage only, the droplet and DNS stay.
+            # The action is saved with the stage, so a resumed reset waits
+            # for the rebuild rather than probing the old image
+            lab.do_action = rebuild_instance(lab.do_reference, image=self.images.snapshots())
+            self._transition(lab, LabStatus.WAITING_HEALTH)
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Instance Reset Error {e}")
+            self._transition(lab, LabStatus.UNKNOWN)
+            if status_callback is not None:
+                status_callback.send(f"Instance Reset Failed - {e}")
+                status_callback.close()
+            return None
 
+        return self._build(lab, False, status_callback, _start)
+
+    def destroy_all(self, status_callback=None):
+        """
+        Empty the admission line, then destroy every lab. Jobs parked in
+        the line should be failed first (JobQueue does), waking them here
+        would otherwise start their labs in the freed slots.
+        """
+
+        self.wait_ready()
+        with self.list_lock:
+            # Freed slots must not go to the line while the fleet comes down
+            cancelled = self.admissions.clear()
+            self.fleet.queue(())
+            owners = sorted(self.index.owners(*LabStatus))
+        # Blocked waiters wake to find they no longer hold a slot
+        self._start_admitted(cancelled)
+
+        return self._destroy_many(owners, status_callback)
+
+    def _destroy_many(self, owners, status_callback=None, callback_factory=None):
+        """
+        Destroy the labs of owners concurrently, with an optional status
+        callback per lab from callback_factory. Returns (done, failed).
+        """
 
         if status_callback is not None:
             next(status_callback)
+            status_callback.send(
+                f"Starting instance termination for {len(owners)} labs, {LAB_DESTROY_WORKERS} at a time"
+            )
 
-        for slack_id in owners:
-            if status_callback is not None:
-                status_callback.send(f"Starting instance termination for {slack_id}")
-            self.destroy_lab(slack_id)
-            if status_callback is not None:
-                status_callback.send(f"Done instance termination for {slack_id}")
+        # Tear down in parallel, progress is reported from this thread only
+        # as the status callback generator is not thread safe
+        done, failed = [], []
+        with ThreadPoolExecutor(
+            max_workers=LAB_DESTROY_WORKERS, thread_name_prefix="labbot-destroy"
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self.destroy_lab,
+                    slack_id,
+                    callback_factory(slack_id) if callback_factory else None,
+                ): slack_id
+                for slack_id in owners
+            }
+            for future in as_completed(futures):
+                slack_id = futures[future]
+                try:
+                    if future.result() is None:
+                        raise LabCloudException("termination failed, lab left UNKNOWN")
+                    done.append(slack_id)
+                    if status_callback is not None:
+                        status_callback.send(
+                            f"Done instance termination for {slack_id} ({len(done) + len(failed)}/{len(owners)})"
+                        )
+                except Exception as e:
+                    failed.append(slack_id)
+                    logger.error(f"Instance termination for {slack_id} failed {e}")
+                    if status_callback is not None:
+                        status_callback.send(
+                            f"Failed instance termination for {slack_id} - {e} ({len(done) + len(failed)}/{len(owners)})"
+                        )
 
         if status_callback is not None:
-            status_callback.send(f"Done...")
+            status_callback.send(
+                f"Done... {len(done)} terminated, {len(failed)} failed"
+                + (f" ({', '.join(failed)})" if failed else "")
+            )
             status_callback.close()
 
-    def expire_labs(self):
-        pass
+        return done, failed
+
+    def expire_labs(self, slack_ids=None, status_callback=None):
+        """
+        Destroy active labs that are past their expiry, limited to slack_ids
+        when given. Labs extended since being picked are left alone.
+        """
+
+        self.wait_ready()
+        now = time.time()
+        with self.list_lock:
+            keys = {
+                self.index.owner(k): k
+                for k in self.index.by_status(LabStatus.ACTIVE)
+                if (self.expiry.expires(k) or now + 1) <= now
+                and (slack_ids is None or self.index.owner(k) in slack_ids)
+            }
+        owners = sorted(keys)
+        if owners:
+            # Extended on another replica since this one last synced
+            with self.db.session() as s:
+                extended = {
+                    owner
+                    for owner, in s.query(Lab.slack_owner_id).filter(
+                        Lab.slack_owner_id.in_(owners), Lab.ts_expires > datetime.now()
+                    )
+                }
+            owners = [o for o in owners if o not in extended]
+
+        done, failed = self._destroy_many(
+            owners, status_callback, callback_factory=self.callback_factory
+        )
+        for slack_id in done:
+            self.expiry.notify(slack_id, "Your lab has expired and has been terminated")
+        # Busy or a cloud error, it is still due
+        for slack_id in failed:
+            self.expiry.retry(keys[slack_id], slack_id)
+
+        return done, failed
+
+    def extend_lab(self, slack_id):
+        """ Push the expiry of slack_id's active lab out to a full lifetime from now """
+
+        self.wait_ready()
+        with self.list_lock:
+            key = self.index.live(slack_id)
+            if key is None or self.index.status(key) is not LabStatus.ACTIVE:
+                raise LabExists(
+                    f"Slack ID {slack_id} does not have an active lab to extend"
+                )
+
+        # Only the one column, the lab may be leased by another replica
+        expires = datetime.now() + timedelta(seconds=self.lab_lifetime)
+        extended = self.db.write(
+            lambda s: s.query(Lab)
+            .filter(Lab.id == int(key), Lab.status == LabStatus.ACTIVE)
+            .update({Lab.ts_expires: expires}, synchronize_session=False)
+        )
+        if not extended:
+            raise LabExists(
+                f"Slack ID {slack_id} does not have an active lab to extend"
+            )
+        with self.list_lock:
+            if key in self._labs:
+                lab = self._checkout(key)
+                lab.ts_expires = expires
+                self._index(lab)
+        self.expiry.schedule(key, slack_id, expires)
+
+        return expires
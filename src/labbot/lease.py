@@ -0,0 +1,156 @@
+# flake8: noqa E501
+"""
+*LabBot* - Database leases shared between bot replicas
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+A row with lease_owner / lease_expires columns belongs to the replica
+named in lease_owner until lease_expires, after which any replica may
+take it over and carry on with whatever the row was part way through.
+
+"""
+
+import os
+import sys
+import time
+import socket
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+
+logger = logging.getLogger(__name__)
+
+# Give each replica a stable id to take its own leases back straight
+# away after a restart, otherwise they are taken over once they expire
+REPLICA_ID = os.environ.get("LABBOT_REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = float(os.environ.get("LABBOT_LEASE_TTL", 30))
+
+
+class LeaseKeeper(object):
+    """
+    Leases this replica holds on rows of model, keyed by column
+
+    acquire() takes a row that is free, expired or already this replica's
+    and not in use by another thread here. A heartbeat thread renews every
+    held lease each ttl / 3 seconds, a lease it finds taken over (this
+    replica stalled for longer than ttl) is dropped.
+    """
+
+    def __init__(self, db, model, column, ttl=LEASE_TTL):
+        self.db = db
+        self.model = model
+        self.column = column
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._held = set()
+        self._thread = None
+
+    def holds(self, key):
+        with self._lock:
+            return key in self._held
+
+    def fields(self):
+        """ Lease columns for a row inserted already leased, track() it once committed """
+        return dict(lease_owner=REPLICA_ID, lease_expires=datetime.now() + timedelta(seconds=self.ttl))
+
+    def track(self, key):
+        with self._lock:
+            self._held.add(key)
+        self._start()
+
+    def acquire(self, key):
+        """ True if this thread now holds key's lease """
+        model = self.model
+        with self._lock:
+            if key in self._held:
+                return False
+            self._held.add(key)
+
+        now = datetime.now()
+        try:
+            taken = self.db.write(
+                lambda s: s.query(model)
+                .filter(
+                    self.column == key,
+                    or_(
+                        model.lease_owner.is_(None),
+                        model.lease_owner == REPLICA_ID,
+                        model.lease_expires < now,
+                    ),
+                )
+                .update(
+                    {
+                        model.lease_owner: REPLICA_ID,
+                        model.lease_expires: now + timedelta(seconds=self.ttl),
+                    },
+                    synchronize_session=False,
+                )
+            )
+        except Exception:
+            self.forget(key)
+            raise
+        if not taken:
+            self.forget(key)
+            return False
+        self._start()
+        return True
+
+    def release(self, key):
+        """ Give key's lease up so any replica may take the row """
+        model = self.model
+        with self._lock:
+            if key not in self._held:
+                return
+            self._held.discard(key)
+        self.db.write(
+            lambda s: s.query(model)
+            .filter(self.column == key, model.lease_owner == REPLICA_ID)
+            .update({model.lease_owner: None, model.lease_expires: None}, synchronize_session=False)
+        )
+
+    def forget(self, key):
+        """ Stop renewing key without touching its row, for deleted rows """
+        with self._lock:
+            self._held.discard(key)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run, name=f"labbot-lease-{self.model.__tablename__}", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            try:
+                self.renew()
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Lease renewal for {self.model.__tablename__} failed {e}")
+
+    def renew(self):
+        model = self.model
+        with self._lock:
+            keys = set(self._held)
+        if not keys:
+            return
+
+        until = datetime.now() + timedelta(seconds=self.ttl)
+
+        def renew(s):
+            mine = s.query(model).filter(self.column.in_(keys), model.lease_owner == REPLICA_ID)
+            mine.update({model.lease_expires: until}, synchronize_session=False)
+            return {key for key, in mine.with_entities(self.column)}
+
+        lost = keys - self.db.write(renew)
+        with self._lock:
+            # Rows released or deleted meanwhile are not lost
+            lost &= self._held
+            self._held -= lost
+        for key in lost:
+            logger.warn(f"Lost the lease on {self.model.__tablename__} {key} to another replica")
@@ -0,0 +1,166 @@
+# flake8: noqa E501
+"""
+*LabBot* - In process metrics
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Histograms of lab stage and cloud API call times, plus gauges read on
+demand, exposed in the Prometheus text format over a small HTTP server.
+
+"""
+
+import logging
+import threading
+from bisect import bisect_left
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+STAGE_BUCKETS = (1, 2, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+API_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+_lock = threading.Lock()
+_histograms = dict()
+_gauges = dict()
+
+
+def _labels(names, values):
+    return ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+
+
+class Histogram(object):
+    """ Cumulative bucket counts, sum and count per label set """
+
+    def __init__(self, name, help, labels=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = dict()
+        with _lock:
+            _histograms[name] = self
+
+    def observe(self, value, *labels):
+        with _lock:
+            counts, total = self._series.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._series[labels] = (counts, total + value)
+
+    def quantile(self, q, *labels):
+        """ Upper bound of the bucket holding the q quantile, None if empty """
+        with _lock:
+            counts = self._series.get(labels, ([], 0))[0]
+        rank, seen = q * sum(counts), 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def series(self):
+        with _lock:
+            return {k: (list(c), t) for k, (c, t) in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self.series().items()):
+            base = _labels(self.labels, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = ",".join(x for x in (base, f'le="{bound}"') if x)
+                lines.append(f"{self.name}_bucket{{{le}}} {cumulative}")
+            suffix = f"{{{base}}}" if base else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+def gauge(name, help, labels, fn):
+    """ Register fn() returning {label values tuple: value}, read on every scrape """
+    with _lock:
+        _gauges[name] = (help, labels, fn)
+
+
+def render():
+    """ Every metric in the Prometheus text exposition format """
+    with _lock:
+        histograms = list(_histograms.values())
+        gauges = list(_gauges.items())
+    lines = []
+    for h in histograms:
+        lines.extend(h.render())
+    for name, (help, labels, fn) in gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+        try:
+            values = fn()
+        except Exception as e:
+            logger.warn(f"Metric {name} failed {e}")
+            continue
+        for label_values, value in sorted(values.items()):
+            base = _labels(labels, label_values)
+            lines.append(f"{name}{{{base}}} {value}" if base else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def summary(histogram):
+    """ One line per series of histogram with count, mean and p50 / p95 bounds """
+    lines = []
+    for labels, (counts, total) in sorted(histogram.series().items()):
+        count = sum(counts)
+        p50, p95 = (
+            f"<= {b}s" if b != float("inf") else f"> {histogram.buckets[-1]}s"
+            for b in (histogram.quantile(q, *labels) for q in (0.5, 0.95))
+        )
+        lines.append(
+            f"{' '.join(labels) or 'all'}: {count} in, mean {total / count:.1f}s, p50 {p50}, p95 {p95}"
+        )
+    return lines
+
+
+STAGE_SECONDS = Histogram(
+    "labbot_lab_stage_seconds", "Time labs spent in each status", ("stage",)
+)
+READY_SECONDS = Histogram(
+    "labbot_lab_ready_seconds", "Time from lab request to ACTIVE", ("pooled",)
+)
+ACTIVE_SECONDS = Histogram(
+    "labbot_droplet_active_seconds", "Time from droplet create to active"
+)
+API_SECONDS = Histogram(
+    "labbot_api_call_seconds",
+    "Cloud API call latency",
+    ("provider", "operation", "ok"),
+    API_BUCKETS,
+)
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        payload = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(port, host="127.0.0.1"):
+    """ Serve /metrics on host:port from a daemon thread """
+    server = _MetricsServer((host, port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="labbot-metrics", daemon=True
+    ).start()
+    logger.info(f"Metrics on http://{host}:{server.server_port}/metrics")
+    return server
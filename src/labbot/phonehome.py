@@ -0,0 +1,145 @@
+# flake8: noqa E501
+"""
+*LabBot* - Lab phone home listener
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+New droplets get a cloud-init script that waits for the lab service on
+:8443 and then calls back here with a one time token, so a lab is known
+to be ready one request after it is, rather than at the next probe.
+
+"""
+
+import os
+import shlex
+import logging
+import secrets
+import threading
+from concurrent.futures import Future
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from labbot.singleton import Singleton
+from labbot.prober import HealthProber, PROBE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Seconds without a phone home before health polling starts as well
+PHONE_HOME_FALLBACK = float(os.environ.get("LAB_PHONE_HOME_FALLBACK", 20))
+
+_SCRIPT = """#!/bin/sh
+# LabBot phone home, tell the bot once the lab service answers
+name=$(curl -s http://169.254.169.254/metadata/v1/hostname | tr A-Z a-z)
+case "$name" in
+{cases}
+esac
+[ -n "$token" ] || exit 0
+until curl -fso /dev/null -m 2 http://127.0.0.1:8443/; do sleep 0.5; done
+curl -fs -m 5 --retry 10 --retry-connrefused -X POST {url}/phone-home/"$token"
+"""
+
+
+class _PhoneHomeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _PhoneHomeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        parts = self.path.split("?")[0].strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "phone-home" or not PhoneHome().called(parts[1]):
+            self.send_error(404)
+            return
+        self.send_response(204)
+        self.end_headers()
+
+
+class PhoneHome(object, metaclass=Singleton):
+    """
+    Singleton listener for droplets reporting their lab service is up
+
+    expect() hands out a token for user_data(), ready() then resolves on
+    that token's call, or on a health probe if none came within
+    PHONE_HOME_FALLBACK seconds. Without serve() no tokens are handed out
+    and ready() is the plain probe.
+    """
+
+    def __init__(self, fallback=PHONE_HOME_FALLBACK):
+        self.fallback = fallback
+        self.url = None
+        # Reentrant, resolving a future runs callbacks that take it
+        self._lock = threading.RLock()
+        self._expected = dict()
+
+    @property
+    def enabled(self):
+        return self.url is not None
+
+    def serve(self, port, url=None, host="0.0.0.0"):
+        """ Listen on host:port, url is how droplets reach it (default host:port) """
+        server = _PhoneHomeServer((host, port), _PhoneHomeHandler)
+        threading.Thread(
+            target=server.serve_forever, name="labbot-phone-home", daemon=True
+        ).start()
+        self.url = (url or f"http://{host}:{server.server_port}").rstrip("/")
+        logger.info(f"Phone home on {host}:{server.server_port} as {self.url}")
+        return server
+
+    def expect(self):
+        """ New one time token, None when not listening """
+        if not self.enabled:
+            return None
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            self._expected[token] = Future()
+        return token
+
+    def user_data(self, tokens):
+        """ cloud-init script for droplets {name: token}, each finds its own token by name """
+        cases = "\n".join(
+            f"  {shlex.quote(name.lower())}) token={shlex.quote(token)} ;;"
+            for name, token in tokens.items()
+            if token is not None
+        )
+        return _SCRIPT.format(cases=cases, url=shlex.quote(self.url))
+
+    def called(self, token):
+        """ token's droplet is up, False if the token is unknown or used """
+        with self._lock:
+            future = self._expected.get(token)
+            if future is None or future.done():
+                return False
+            # Kept until ready() picks it up, the call may beat it
+            future.set_result(True)
+        return True
+
+    def forget(self, token):
+        """ Drop a token whose droplet will not be waited on """
+        with self._lock:
+            self._expected.pop(token, None)
+
+    def ready(self, token, urls, timeout=PROBE_TIMEOUT):
+        """
+        Future resolving to the first of urls once the droplet phones home,
+        or to whichever answers a probe first, None if neither before timeout
+        """
+        with self._lock:
+            phoned = self._expected.get(token)
+        probe = HealthProber().probe(urls, timeout, delay=self.fallback if phoned else 0)
+        if phoned is None:
+            return probe
+
+        result = Future()
+
+        def resolve(url):
+            with self._lock:
+                self._expected.pop(token, None)
+                if result.done():
+                    return
+                result.set_result(url)
+            probe.cancel()
+
+        phoned.add_done_callback(lambda f: resolve(urls[0]))
+        probe.add_done_callback(lambda f: f.cancelled() or resolve(f.result()))
+        return result
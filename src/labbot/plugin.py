@@ -8,20 +8,39 @@ Training / Presentation session virtual container management system
 """
 
 import re
+import time
 import logging
+import threading
 import simplejson as json
 from machine.plugins.base import MachineBasePlugin
 from machine.plugins.decorators import respond_to, listen_to
+from machine.singletons import Slack
 from inspect import cleandoc
 from .version import __version__
-from labbot.database import DB, Lab
+from labbot.database import DB, Lab, JobKind, LabStatus
 from sqlalchemy import and_
 from .lab import LabManager
-from .errors import LabExists, LabCloudException, LabCloudTimeout, LabTotalExceeded
+from .jobs import JobQueue
+from .status import StatusReporter
+from . import metrics
+from .cloud.clients import stats
+from .cloud.placement import RegionPlacer
+from .cloud.do import hedge_after, hedge_stats
+from .pool import POOL_STATUSES
+from .lease import REPLICA_ID
+from .phonehome import PhoneHome
+from .errors import LabExists, LabCloudException, LabCloudTimeout, LabNotReady
 
 logger = logging.getLogger(__name__)
 
 
+def _elapsed(since):
+    seconds = int(time.time() - since)
+    if seconds < 120:
+        return f"{seconds}s"
+    return f"{seconds // 60}m"
+
+
 class LabBotPlugin(MachineBasePlugin):
     """
     *LabBot*
@@ -36,9 +55,37 @@ class LabBotPlugin(MachineBasePlugin):
 
         # from pudb import set_trace; set_trace()
         self.db = DB(self.settings["LABBOT_DB_URL"])
+        self.status = StatusReporter(
+            self.post_status,
+            self.update_status,
+            window=float(self.settings.get("LABBOT_STATUS_WINDOW", 2)),
+        )
         self.manager = LabManager(
-            self.db, default_max_labs=10, default_lab_lifetime=60 * 60
+            self.db,
+            default_max_labs=int(self.settings.get("LABBOT_MAX_LABS", 10)),
+            default_lab_lifetime=60 * 60,
+            pool_size=int(self.settings.get("LABBOT_POOL_SIZE", 0)),
+            callback_factory=self.make_dm_status_callback,
+            hedge=str(self.settings.get("LABBOT_HEDGE", "")).lower() in ("1", "true", "yes"),
         )
+        self.jobs = JobQueue(
+            self.manager,
+            self.make_dm_status_callback,
+            workers=int(self.settings.get("LABBOT_JOB_WORKERS", 4)),
+        )
+        self.jobs.start()
+        if self.settings.get("LABBOT_METRICS_PORT"):
+            metrics.serve(
+                int(self.settings["LABBOT_METRICS_PORT"]),
+                self.settings.get("LABBOT_METRICS_HOST", "127.0.0.1"),
+            )
+        if self.settings.get("LABBOT_PHONE_HOME_PORT"):
+            # The URL must reach this replica, droplets call back the one that made them
+            PhoneHome().serve(
+                int(self.settings["LABBOT_PHONE_HOME_PORT"]),
+                self.settings.get("LABBOT_PHONE_HOME_URL"),
+                self.settings.get("LABBOT_PHONE_HOME_HOST", "0.0.0.0"),
+            )
         self.admin_channel = self.settings.get("ADMIN_CHANNEL", None)
         logger.info("LabBot active")
 
@@ -46,36 +93,152 @@ class LabBotPlugin(MachineBasePlugin):
     # def module_help(self, msg):
     # msg.reply(cleandoc(cls.__doc__).format(**{"version": __version__})
 
-    @staticmethod
-    def make_lab_status_callback(msg):
-        while True:
-            status_message = yield
-            msg.reply_dm(f"Lab Status : {status_message}")
+    def make_dm_status_callback(self, slack_id):
+        return self.status.callback(slack_id)
 
-    @respond_to(r"^lab reset$", re.IGNORECASE)
-    def lab_reset(self, msg):
-        msg.reply(f"Reset lab attempt")
+    def post_status(self, slack_id, text):
+        r = self.send_dm_webapi(slack_id, text)
+        if not r.get("ok"):
+            logger.warn(f"Status DM to {slack_id} failed {r.get('error')}")
+            return None
+        return (r["channel"], r["ts"])
+
+    def update_status(self, handle, text):
+        channel, ts = handle
+        Slack.get_instance().api_call("chat.update", channel=channel, ts=ts, text=text)
 
+    def _authorized(self, msg):
+        """ True if msg came from the admin channel, the first admin command claims it if unset """
         if self.admin_channel is None:
             self.admin_channel = msg.channel.id
             logger.warn(f"admin channel set to {self.admin_channel}\n{msg.channel}")
 
         if msg.channel.id != self.admin_channel:
-            logger.warn(f"Unauthorized admin command")
+            logger.warn(f"Unauthorized admin command in {msg.channel.id}")
+            msg.reply("Admin commands are not authorized in this channel")
+            return False
+        return True
+
+    @respond_to(r"^lab reset$", re.IGNORECASE)
+    def lab_reset(self, msg):
+        msg.reply(f"Reset lab attempt")
+
+        if not self._authorized(msg):
+            return
+
+        job = self.jobs.submit(JobKind.DESTROY_ALL, msg.sender.id)
+        msg.reply(f"Destroying all labs, job #{job} queued")
+
+    @respond_to(r"^lab class (?P<roster>.+)$", re.IGNORECASE)
+    def lab_class(self, msg, roster):
+        if not self._authorized(msg):
+            return
+
+        # Mentions arrive as <@U123> or <@U123|name>, bare IDs work too
+        slack_ids = list(dict.fromkeys(re.findall(r"<?@?([UW][A-Z0-9]+)(?:\|[^>]*)?>?", roster)))
+        if not slack_ids:
+            msg.reply("No Slack users found, use 'lab class @user1 @user2 ...'")
+            return
+
+        msg.reply(f"Provisioning {len(slack_ids)} labs")
+        threading.Thread(
+            target=self.manager.create_labs,
+            args=(slack_ids,),
+            kwargs=dict(
+                status_callback=self.make_dm_status_callback(msg.sender.id),
+                callback_factory=self.make_dm_status_callback,
+            ),
+            name="labbot-class",
+            daemon=True,
+        ).start()
+
+    @respond_to(r"^lab image( (?P<action>build)( (?P<region>[A-Za-z0-9]+))?)?$", re.IGNORECASE)
+    def lab_image(self, msg, action, region):
+        if not self._authorized(msg):
+            return
+
+        images = self.manager.images
+        try:
+            self.manager.wait_ready()
+        except LabNotReady as e:
+            msg.reply(f"{e}")
+            return
+
+        if action is None:
+            snapshots = images.snapshots()
+            if not snapshots:
+                msg.reply("No lab image built yet, labs boot from the stock image")
+            else:
+                msg.reply(
+                    "\n".join(
+                        f"Labs in {r} boot from image v{images.version(r)} ({snapshots[r]})"
+                        for r in sorted(snapshots)
+                    )
+                )
+            return
+
+        threading.Thread(
+            target=images.build,
+            args=(self.make_dm_status_callback(msg.sender.id), region.upper() if region else None),
+            name="labbot-image",
+            daemon=True,
+        ).start()
+        msg.reply("Image build started")
+
+    @respond_to(r"^lab metrics$", re.IGNORECASE)
+    def lab_metrics(self, msg):
+        if not self._authorized(msg):
             return
 
-        msg.reply(f"Destroying all labs")
-        self.manager.destroy_all(self.make_lab_status_callback(msg))
+        lines = [f"*Replica* {REPLICA_ID}" + (" (leader)" if self.manager.is_leader() else "")]
+        lines += ["*Time in stage*"] + metrics.summary(metrics.STAGE_SECONDS)
+        lines += ["*Time to ready (pooled)*"] + metrics.summary(metrics.READY_SECONDS)
+        lines += ["*Cloud API*"] + [
+            f"{provider}: {s['calls']} calls, {s['errors']} errors, mean {s['mean']:.2f}s, max {s['max']:.2f}s, {s['queued']} queued"
+            for provider, s in sorted(stats().items())
+        ]
+        lines += ["*Regions*"] + [
+            f"{region}: "
+            + (f"active in {s['latency']:.0f}s" if s["latency"] is not None else "no creates yet")
+            + f", {s['failure_rate']:.0%} failing, {s['inflight']} in flight"
+            for region, s in RegionPlacer().stats().items()
+        ]
+        lines += ["*Droplet create to active*"] + metrics.summary(metrics.ACTIVE_SECONDS)
+        if self.manager.hedge:
+            hedges = hedge_stats()
+            lines.append(
+                f"Hedging after {hedge_after():.0f}s, {hedges['launched']} extra droplets, {hedges['won']} used"
+            )
+        msg.reply("\n".join(lines))
+
+    @respond_to(r"^labs$", re.IGNORECASE)
+    def lab_overview(self, msg):
+        if not self._authorized(msg):
+            return
+
+        # The published snapshot, never the lab list lock or the DB
+        view = self.manager.fleet.view()
+        pooled = view.count(*POOL_STATUSES)
+        lines = [
+            f"*Labs* {len(view.labs) - pooled} of {self.manager.max_labs} in use, "
+            f"{len(view.queue)} waiting, {view.count(LabStatus.POOL_READY)} of {pooled} pooled ready"
+        ]
+        if not self.manager.ready.is_set():
+            lines.append("Still loading the lab list")
+        lines += [f"{status.name}: {view.counts[status]}" for status in LabStatus if view.counts.get(status)]
+        lines += [
+            f"{lab.owner or 'pool'} #{lab.key} {lab.status.name} {_elapsed(lab.since)}"
+            + (f" {lab.url}" if lab.url else "")
+            for lab in sorted(view.labs.values(), key=lambda lab: (lab.status.value, lab.since))
+        ]
+        msg.reply("\n".join(lines))
 
     @respond_to(r"^makelab$")
     def make_lab(self, msg):
         try:
 
-            msg.reply_dm(f"Making a lab for {msg.sender.id}")
-            self.manager.create_lab(msg.sender.id, self.make_lab_status_callback(msg))
-            msg.reply_dm(f"Request finished")
-        except (LabExists, LabTotalExceeded, LabCloudTimeout) as e:
-            msg.reply_dm(f"{e}")
+            job = self.jobs.submit(JobKind.CREATE, msg.sender.id)
+            msg.reply_dm(f"Making a lab for {msg.sender.id}, request #{job} queued")
         except Exception as e:
             msg.reply_dm(f"Unhandled Exception {e}")
 
@@ -83,10 +246,45 @@ class LabBotPlugin(MachineBasePlugin):
     def kill_lab(self, msg):
         try:
 
-            msg.reply_dm(f"Destroying lab for {msg.sender.id}")
-            self.manager.destroy_lab(msg.sender.id, self.make_lab_status_callback(msg))
-            msg.reply_dm(f"Request finished")
-        except (LabExists, LabTotalExceeded, LabCloudTimeout) as e:
+            job = self.jobs.submit(JobKind.DESTROY, msg.sender.id)
+            msg.reply_dm(f"Destroying lab for {msg.sender.id}, request #{job} queued")
+        except Exception as e:
+            msg.reply_dm(f"Unhandled Exception {e}")
+
+    @respond_to(r"^resetlab$")
+    def reset_lab(self, msg):
+        try:
+
+            job = self.jobs.submit(JobKind.RESET, msg.sender.id)
+            msg.reply_dm(f"Resetting lab for {msg.sender.id}, request #{job} queued")
+        except Exception as e:
+            msg.reply_dm(f"Unhandled Exception {e}")
+
+    @respond_to(r"^labstatus$")
+    def lab_status(self, msg):
+        if not self.manager.ready.is_set():
+            msg.reply_dm("LabBot is still starting up, try again in a moment")
+            return
+
+        view = self.manager.fleet.view()
+        lab = view.lab(msg.sender.id)
+        position = view.position(msg.sender.id)
+        if lab is not None and lab.status is LabStatus.ACTIVE:
+            msg.reply_dm(f"Your lab is ready at {lab.url}, it expires at {lab.expires:%H:%M}")
+        elif lab is not None:
+            msg.reply_dm(f"Your lab is {lab.status.name} for {_elapsed(lab.since)}")
+        elif position is not None:
+            msg.reply_dm(f"You are #{position} in line for a lab")
+        else:
+            msg.reply_dm("You do not have a lab, start one with 'makelab'")
+
+    @respond_to(r"^extendlab$")
+    def extend_lab(self, msg):
+        try:
+
+            expires = self.manager.extend_lab(msg.sender.id)
+            msg.reply_dm(f"Lab extended, it will now expire at {expires:%H:%M}")
+        except (LabExists, LabNotReady) as e:
             msg.reply_dm(f"{e}")
         except Exception as e:
             msg.reply_dm(f"Unhandled Exception {e}")
@@ -0,0 +1,184 @@
+# flake8: noqa E501
+"""
+*LabBot* - Warm pool of pre-provisioned lab instances
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Keeps a number of droplets booted and health checked ahead of demand, so
+that makelab only has to attach DNS and an owner.
+
+"""
+
+import os
+import sys
+import logging
+import threading
+import traceback
+from datetime import datetime
+from sqlalchemy import or_
+from labbot.database import Lab, LabStatus
+from labbot.cloud.do import create_instance, destroy_instance, tag_instance, untag_instance
+from labbot.phonehome import PhoneHome
+
+logger = logging.getLogger(__name__)
+
+POOL_TAG = os.environ.get("LAB_POOL_TAG", "unassigned")
+POOL_INTERVAL = int(os.environ.get("LAB_POOL_INTERVAL", 30))
+POOL_HEALTH_TIMEOUT = int(os.environ.get("LAB_POOL_HEALTH_TIMEOUT", 300))
+
+POOL_STATUSES = (
+    LabStatus.POOL_WAITING_INSTANCE,
+    LabStatus.POOL_WAITING_HEALTH,
+    LabStatus.POOL_READY,
+)
+
+
+class LabPool(object):
+    """
+    Background replenisher for unassigned lab instances
+
+    Pool labs live in the labs table with no owner and one of the
+    POOL_* statuses, and share the LabManager lab list and lock. Only
+    the leader replica tops the pool up, any replica may claim from it.
+    """
+
+    def __init__(self, manager, size, interval=POOL_INTERVAL):
+        self.manager = manager
+        self.size = size
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.size <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="labbot-pool", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"Lab pool started, target size {self.size}")
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def claim(self, s, slack_id, lease):
+        """
+        Hand a ready pool lab to slack_id inside the reservation session s,
+        leased with the lease columns. Returns the claimed row, or None if
+        the pool is empty.
+        """
+        now = datetime.now()
+        free = or_(Lab.lease_owner.is_(None), Lab.lease_expires < now)
+        ready = (
+            s.query(Lab)
+            .filter(Lab.status == LabStatus.POOL_READY, Lab.slack_owner_id.is_(None), free)
+            .order_by(Lab.id)
+            .limit(5)
+            .all()
+        )
+        for lab in ready:
+            # The reconciler may have leased it since it was read
+            claimed = (
+                s.query(Lab)
+                .filter(Lab.id == lab.id, Lab.status == LabStatus.POOL_READY, free)
+                .update(
+                    dict(
+                        slack_owner_id=slack_id,
+                        status=LabStatus.WAITING_DNS,
+                        ts_updated=now,
+                        **lease,
+                    ),
+                    synchronize_session=False,
+                )
+            )
+            if claimed:
+                s.refresh(lab)
+                return lab
+        return None
+
+    def release(self, lab):
+        """ Swap the pool tag for the owner tag on a claimed instance """
+        try:
+            untag_instance(lab.do_reference, POOL_TAG)
+            tag_instance(lab.do_reference, lab.slack_owner_id)
+        except Exception as e:
+            # Tags are bookkeeping only, the lab is still usable
+            logger.warn(f"Unable to retag pool instance {lab.do_reference} {e}")
+
+    def pending(self):
+        """ Number of pool labs booting or ready, must hold list_lock """
+        return self.manager.index.count(*POOL_STATUSES)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                with self.manager.list_lock:
+                    missing = self.size - self.pending() if self.manager.is_leader() else 0
+                workers = [
+                    threading.Thread(target=self._provision, daemon=True)
+                    for _ in range(max(missing, 0))
+                ]
+                for w in workers:
+                    w.start()
+                for w in workers:
+                    w.join()
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Lab pool replenish error {e}")
+
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def _provision(self):
+        manager = self.manager
+        lab = Lab(
+            status=LabStatus.POOL_WAITING_INSTANCE,
+            active=True,
+            instances=0,
+            **manager.leases.fields(),
+        )
+        manager.db.write(lambda s: s.add(lab))
+        manager.leases.track(lab.id)
+        with manager.list_lock:
+            manager._index(lab)
+
+        logger.debug(f"Creating pool Lab {lab.id}")
+
+        token = None
+        try:
+            token = PhoneHome().expect()
+            _instance_id, _ip = create_instance(
+                f"pool-{lab.id}",
+                tags=[POOL_TAG],
+                image=manager.images.snapshots(),
+                phone_home=token,
+            )
+            lab.do_reference = _instance_id
+            lab.ip = _ip
+            manager._transition(lab, LabStatus.POOL_WAITING_HEALTH)
+
+            _url = f"http://{lab.ip}:8443"
+            if PhoneHome().ready(token, [_url], POOL_HEALTH_TIMEOUT).result() is None:
+                raise Exception(f"Health check failed on {lab.ip}")
+
+            manager._transition(lab, LabStatus.POOL_READY)
+            logger.info(f"Pool Lab {lab.id} ready on {lab.ip}")
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Pool instance creation error {e}")
+            PhoneHome().forget(token)
+            if lab.do_reference is not None:
+                try:
+                    destroy_instance(lab.do_reference)
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    manager._transition(lab, LabStatus.UNKNOWN)
+                    return
+            lab.do_reference = None
+            lab.ip = None
+            manager._transition(lab, LabStatus.TERMINATED)
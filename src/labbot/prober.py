@@ -0,0 +1,119 @@
+# flake8: noqa E501
+"""
+*LabBot* - Lab health check prober
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+One scheduler thread and a small pool of probe threads check the health
+endpoint of any number of labs, with exponential backoff and jitter.
+
+"""
+
+import os
+import heapq
+import random
+import logging
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.request import urlopen
+from labbot.singleton import Singleton
+
+logger = logging.getLogger(__name__)
+
+PROBE_WORKERS = int(os.environ.get("LAB_PROBE_WORKERS", 16))
+PROBE_REQUEST_TIMEOUT = float(os.environ.get("LAB_PROBE_REQUEST_TIMEOUT", 3))
+PROBE_BACKOFF_MIN = float(os.environ.get("LAB_PROBE_BACKOFF_MIN", 0.5))
+PROBE_BACKOFF_MAX = float(os.environ.get("LAB_PROBE_BACKOFF_MAX", 10))
+PROBE_TIMEOUT = float(os.environ.get("LAB_HEALTH_TIMEOUT", 60))
+
+
+class _ProbeGroup(object):
+    """ Endpoints of one lab, the first to answer resolves the future """
+
+    def __init__(self, urls, deadline):
+        self.future = Future()
+        self.deadline = deadline
+        self.remaining = len(urls)
+        self.lock = threading.Lock()
+
+    def _finish(self, result):
+        # Must hold lock, the waiter may have cancelled the probe
+        if not self.future.done() and self.future.set_running_or_notify_cancel():
+            self.future.set_result(result)
+
+    def resolve(self, url):
+        with self.lock:
+            self._finish(url)
+
+    def give_up(self):
+        with self.lock:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self._finish(None)
+
+
+class HealthProber(object, metaclass=Singleton):
+    """
+    probe(urls) returns a Future resolving to the first url that answers
+    with a 2xx, or None if none of them do before the timeout. Probing
+    starts after delay seconds, cancel() the future to stop it early.
+    """
+
+    def __init__(self, workers=PROBE_WORKERS):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="labbot-probe"
+        )
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="labbot-prober", daemon=True
+        )
+        self._thread.start()
+
+    def probe(self, urls, timeout=PROBE_TIMEOUT, delay=0):
+        group = _ProbeGroup(urls, time.time() + timeout)
+        for url in urls:
+            self._schedule(min(delay, timeout), group, url, 0)
+        return group.future
+
+    def _schedule(self, delay, group, url, attempt):
+        with self._cond:
+            heapq.heappush(
+                self._heap, (time.time() + delay, next(self._seq), group, url, attempt)
+            )
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(
+                        self._heap[0][0] - time.time() if self._heap else None
+                    )
+                _, _, group, url, attempt = heapq.heappop(self._heap)
+            if not group.future.done():
+                self._executor.submit(self._attempt, group, url, attempt)
+
+    def _attempt(self, group, url, attempt):
+        try:
+            if int(urlopen(url, timeout=PROBE_REQUEST_TIMEOUT).getcode() / 100) == 2:
+                logger.debug(f"Health check on {url} passed after {attempt + 1} attempts")
+                group.resolve(url)
+                return
+        except Exception as e:
+            logger.debug(f"Health check on {url} attempt {attempt + 1} failed {e}")
+
+        if group.future.done():
+            return
+
+        # Full jitter, so a class worth of labs does not probe in lock step
+        delay = random.uniform(
+            PROBE_BACKOFF_MIN, min(PROBE_BACKOFF_MIN * 2 ** attempt, PROBE_BACKOFF_MAX)
+        )
+        if time.time() + delay > group.deadline:
+            group.give_up()
+            return
+        self._schedule(delay, group, url, attempt + 1)
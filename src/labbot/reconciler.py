@@ -0,0 +1,212 @@
+# flake8: noqa E501
+"""
+*LabBot* - Lab / cloud state reconciler
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+Diffs the labs table against the labbot tagged droplets and the lab DNS
+records, using one bulk list per provider, and resumes, rolls back or
+garbage collects whatever does not match.
+
+"""
+
+import os
+import sys
+import time
+import calendar
+import logging
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from labbot.database import Lab, LabJob, LabStatus, JobStatus
+from labbot.cloud.do import list_instances, destroy_instance, DO_HEDGE_TAG, DO_TIMEOUT
+from labbot.cloud.cloudflare import list_lab_a_records, delete_lab_a_record
+from labbot.images import IMAGE_TAG, IMAGE_BUILD_GRACE
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = int(os.environ.get("LAB_RECONCILE_INTERVAL", 10 * 60))
+RECONCILE_GRACE = int(os.environ.get("LAB_RECONCILE_GRACE", 15 * 60))
+RECONCILE_WORKERS = int(os.environ.get("LAB_RECONCILE_WORKERS", 8))
+# A hedged droplet nobody claimed this long after its create has lost
+RECONCILE_HEDGE_GRACE = int(os.environ.get("LAB_RECONCILE_HEDGE_GRACE", DO_TIMEOUT + 60))
+
+HEALTHY_STATUSES = (LabStatus.ACTIVE, LabStatus.POOL_READY)
+RESUME_STATUSES = (LabStatus.WAITING_DNS, LabStatus.WAITING_HEALTH)
+
+
+def _cloud_ts(value):
+    """ Epoch seconds for a DO / Cloudflare UTC timestamp """
+    for fmt in ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%dT%H:%M:%S.%fZ"):
+        try:
+            return calendar.timegm(datetime.strptime(value, fmt).timetuple())
+        except (TypeError, ValueError):
+            pass
+    # Unparseable, treat as new so it is never collected by mistake
+    return time.time()
+
+
+class Reconciler(object):
+    """
+    Runs at start up and every interval seconds
+
+    Anything touched within the grace period, leased by a replica, or
+    whose owner has a job queued or running, is left alone as it may
+    still be in flight. Only the leader replica reconciles.
+    """
+
+    def __init__(self, manager, interval=RECONCILE_INTERVAL, grace=RECONCILE_GRACE):
+        self.manager = manager
+        self.db = manager.db
+        self.interval = interval
+        self.grace = grace
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="labbot-reconciler", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.manager.is_leader():
+                    self.reconcile()
+            except Exception as e:
+                traceback.print_exc(file=sys.stdout)
+                logger.error(f"Reconcile failed {e}")
+            time.sleep(self.interval)
+
+    def reconcile(self):
+        self.manager.images.fail_stale()
+        # Images the build's own prune had to keep for IMAGE_PRUNE_GRACE
+        self.manager.images.prune()
+        droplets = {d["id"]: d for d in list_instances()}
+        records = {r["id"]: r for r in list_lab_a_records()}
+        cutoff = time.time() - self.grace
+        now = datetime.now()
+
+        with self.db.session() as s:
+            busy = {
+                j.slack_id
+                for j in s.query(LabJob).filter(
+                    LabJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING])
+                )
+            }
+            labs = [
+                (
+                    str(lab.id),
+                    lab.slack_owner_id,
+                    lab.status,
+                    lab.do_reference,
+                    lab.cf_reference,
+                    (lab.ts_updated or lab.ts_created).timestamp(),
+                    lab.lease_owner is not None and lab.lease_expires >= now,
+                )
+                for lab in s.query(Lab).filter(Lab.status != LabStatus.TERMINATED)
+            ]
+
+        actions = []
+        # Leased labs are still in use, their droplets and records count
+        claimed_droplets = {lab[3] for lab in labs if lab[3]}
+        claimed_records = {lab[4] for lab in labs if lab[4]}
+
+        for key, owner, status, do_ref, cf_ref, updated, leased in labs:
+            if leased or owner in busy or updated > cutoff:
+                continue
+            if status in HEALTHY_STATUSES:
+                if do_ref not in droplets:
+                    actions.append(("teardown", key, f"droplet {do_ref} is gone"))
+            elif status is LabStatus.WAITING_INSTANCE and owner is not None:
+                adopt = next(
+                    (
+                        d
+                        for d in droplets.values()
+                        if d["name"] == f"LabBot-{owner}"
+                        and d["id"] not in claimed_droplets
+                        and d["status"] == "active"
+                    ),
+                    None,
+                )
+                if adopt is not None:
+                    claimed_droplets.add(adopt["id"])
+                    actions.append(("adopt", key, adopt))
+                else:
+                    actions.append(("teardown", key, "no droplet was created"))
+            elif status in RESUME_STATUSES and owner is not None and do_ref in droplets:
+                actions.append(("resume", key, status))
+            else:
+                actions.append(("teardown", key, f"stuck in {status}"))
+
+        hedge_cutoff = time.time() - min(self.grace, RECONCILE_HEDGE_GRACE)
+        # Image builds clean up their own reference droplet, unless their
+        # replica died part way through
+        image_cutoff = time.time() - IMAGE_BUILD_GRACE
+        for droplet_id, d in droplets.items():
+            tags = d["tags"] or []
+            if droplet_id in claimed_droplets:
+                continue
+            created = _cloud_ts(d["created_at"])
+            if IMAGE_TAG in tags:
+                if created < image_cutoff:
+                    actions.append(("droplet", droplet_id, d["name"]))
+            elif created < cutoff or (DO_HEDGE_TAG in tags and created < hedge_cutoff):
+                actions.append(("droplet", droplet_id, d["name"]))
+
+        for record_id, r in records.items():
+            if record_id not in claimed_records and _cloud_ts(r["created_on"]) < cutoff:
+                actions.append(("record", record_id, r["name"]))
+
+        logger.info(
+            f"Reconcile: {len(labs)} labs, {len(droplets)} droplets, {len(records)} records, {len(actions)} actions"
+        )
+
+        with ThreadPoolExecutor(
+            max_workers=RECONCILE_WORKERS, thread_name_prefix="labbot-reconcile"
+        ) as executor:
+            for action in actions:
+                executor.submit(self._apply, *action)
+
+        return actions
+
+    def _apply(self, action, ref, detail):
+        logger.warn(f"Reconcile {action} {ref} ({detail})")
+        try:
+            if action == "droplet":
+                destroy_instance(ref)
+            elif action == "record":
+                delete_lab_a_record(ref)
+            else:
+                self._apply_lab(action, ref, detail)
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Reconcile {action} {ref} failed {e}")
+
+    def _apply_lab(self, action, key, detail):
+        manager = self.manager
+        lab = manager._lease(key)
+        if lab is None:
+            return
+        # Picked up by a replica between the scan and now
+        if (lab.ts_updated or lab.ts_created).timestamp() > time.time() - self.grace:
+            manager.leases.release(lab.id)
+            return
+
+        owner = lab.slack_owner_id
+        if action == "teardown":
+            manager._teardown(lab)
+            return
+        if action == "adopt":
+            lab.do_reference = detail["id"]
+            lab.ip = detail["ip"]
+            manager._transition(lab, LabStatus.WAITING_DNS)
+
+        # adopt and resume both carry on with the owner's creation
+        callback = manager.callback_factory(owner) if manager.callback_factory else None
+        if callback is not None:
+            next(callback)
+        manager._build(lab, False, callback, time.time())
@@ -0,0 +1,115 @@
+# flake8: noqa E501
+"""
+*LabBot* - Coalesced Slack status reporting
+Copyright (c) 2019 Richard Clark <richardc@cybrick.com> All rights reserved.
+Copyright (C) 2015 Slackbot Contributors
+
+One Slack message per lab operation, edited in place as the operation
+moves through its stages instead of a new DM for every status line.
+
+"""
+
+import os
+import sys
+import time
+import logging
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+STATUS_WINDOW = float(os.environ.get("LAB_STATUS_WINDOW", 2))
+STATUS_LINES = int(os.environ.get("LAB_STATUS_LINES", 8))
+
+
+class _Report(object):
+    """ Status lines of one operation and the message showing them """
+
+    def __init__(self, target):
+        self.target = target
+        self.lines = []
+        self.dropped = 0
+        self.handle = None
+        self.flushed = 0
+        self.dirty = False
+        self.closed = False
+
+    def add(self, line):
+        self.lines.append(line)
+        if len(self.lines) > STATUS_LINES:
+            # Long runs (lab reset) only keep the latest progress
+            self.dropped += len(self.lines) - STATUS_LINES
+            self.lines = self.lines[-STATUS_LINES:]
+        self.dirty = True
+
+    def render(self):
+        lines = [f"... {self.dropped} earlier updates"] if self.dropped else []
+        return "\n".join(lines + [f"Lab Status : {line}" for line in self.lines])
+
+
+class StatusReporter(object):
+    """
+    callback(target) returns a status callback generator, the same shape
+    LabManager and JobQueue expect from a callback_factory
+
+    Lines sent within window seconds of each other are flushed together,
+    the first flush posts the message and later ones edit it, so a lab
+    costs one post and a handful of edits whatever its number of stages.
+
+    post(target, text) must return a handle that update(handle, text)
+    accepts, or None if the message could not be posted.
+    """
+
+    def __init__(self, post, update, window=STATUS_WINDOW):
+        self.post = post
+        self.update = update
+        self.window = window
+        self._reports = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="labbot-status", daemon=True
+        )
+        self._thread.start()
+
+    def callback(self, target):
+        report = _Report(target)
+        with self._cond:
+            self._reports.append(report)
+        try:
+            while True:
+                line = yield
+                with self._cond:
+                    report.add(line)
+        finally:
+            with self._cond:
+                report.closed = True
+                # Final lines go out now rather than at the next window
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.window)
+                now = time.time()
+                due = [
+                    r
+                    for r in self._reports
+                    if r.dirty and (r.closed or now - r.flushed >= self.window)
+                ]
+                batch = [(r, r.render()) for r in due]
+                for r in due:
+                    r.dirty = False
+                    r.flushed = now
+                self._reports = [r for r in self._reports if r.dirty or not r.closed]
+            for report, text in batch:
+                self._flush(report, text)
+
+    def _flush(self, report, text):
+        try:
+            if report.handle is None:
+                report.handle = self.post(report.target, text)
+            else:
+                self.update(report.handle, text)
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            logger.error(f"Status update to {report.target} failed {e}")